@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Throughput of the database connection setups.
+
+Runs a mix of the dashboard's small queries from several threads with:
+    per call    a new connection and PRAGMAs for every query (the old SQLiteConnection)
+    pooled      the pooled connections of src/database.py
+    immutable   pooled connections opened with immutable=1
+    shm         like immutable, on a copy of the database in --shm (e.g. /dev/shm)
+
+Run from the project root:
+
+    python -m src.benchmark_db [databases/nov18.db] [--threads 8] [--seconds 5] [--shm /dev/shm]
+"""
+import argparse
+import random
+import sqlite3
+import threading
+import time
+from src.database import SQLiteConnection, shared_memory_copy
+from src.funcs import cohort_param
+
+
+class PerCallConnection:
+    """The connection setup before pooling: opened, set up and closed for every query."""
+
+    def __init__(self, db_name):
+        self.conn = sqlite3.connect(f'file:{db_name}?mode=ro', uri=True)
+        self.cursor = self.conn.cursor()
+
+    def __enter__(self):
+        self.cursor.execute("PRAGMA synchronous = OFF;")
+        self.cursor.execute("PRAGMA cache_size = -50000;")
+        self.cursor.execute("PRAGMA temp_store = MEMORY;")
+        self.cursor.execute("PRAGMA optimizer_pragmas = 'all';")
+        return self.conn, self.cursor
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.cursor.close()
+        self.conn.close()
+
+
+def query_mix(piq_ids):
+    """(query, params) pairs like the ones of the callbacks, with random cohorts."""
+    page = cohort_param(random.sample(piq_ids, min(14, len(piq_ids))))
+    cohort = cohort_param(random.sample(piq_ids, min(1000, len(piq_ids))))
+    return [
+        ("""SELECT COUNT(DISTINCT PIQPersonID) FROM BioTable;""", ()),
+        ("""SELECT FullName, ImageURL, PIQPersonID, ExperienceGroup, DateOfBirth, CountryOfBirth
+            FROM BioTable
+            WHERE PIQPersonID IN (SELECT value FROM json_each(?));""", (page,)),
+        ("""SELECT DISTINCT QuestionText
+            FROM QuestionsTable
+            WHERE PIQPersonID IN (SELECT value FROM json_each(?));""", (cohort,)),
+        ("""SELECT QuestionText, Answer, COUNT(*)
+            FROM QuestionsTable
+            WHERE PIQPersonID IN (SELECT value FROM json_each(?))
+            GROUP BY QuestionText, Answer;""", (cohort,)),
+    ]
+
+
+def run(connection, db_name, piq_ids, threads, seconds):
+    """Number of queries per second over all threads."""
+    done = [0] * threads
+    stop = time.time() + seconds
+
+    def worker(i):
+        while time.time() < stop:
+            for query, params in query_mix(piq_ids):
+                with connection(db_name) as (conn, cursor):
+                    cursor.execute(query, params)
+                    cursor.fetchall()
+                done[i] += 1
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    start = time.time()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return sum(done) / (time.time() - start)
+
+
+def close_pools():
+    """Close the idle pooled connections, so the next setup starts cold."""
+    for pool in SQLiteConnection._pools.values():
+        while not pool.empty():
+            pool.get_nowait().close()
+    SQLiteConnection._pools.clear()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('db_name', nargs='?', default='databases/nov18.db')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--shm', default='', help='shared memory directory to also test a copy in')
+    args = parser.parse_args()
+
+    with sqlite3.connect(f'file:{args.db_name}?mode=ro', uri=True) as conn:
+        piq_ids = [r[0] for r in conn.execute("SELECT PIQPersonID FROM BioTable;")]
+
+    setups = [('per call', args.db_name, False), ('pooled', args.db_name, False),
+              ('immutable', args.db_name, True)]
+    if args.shm:
+        setups.append(('shm', shared_memory_copy(args.db_name, args.shm), True))
+
+    for name, path, immutable in setups:
+        SQLiteConnection.immutable = immutable
+        connection = PerCallConnection if name == 'per call' else SQLiteConnection
+        qps = run(connection, path, piq_ids, args.threads, args.seconds)
+        close_pools()
+        print(f'{name:>10}: {qps:8.0f} queries/s')
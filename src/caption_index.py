@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+Caption level index of the testimonies, with the timecodes of the WebVTT files.
+
+TestimonyTable has one string per tape, and TestimonyTable_fts one per
+interview, so a search can only say which interview matches. CaptionTable
+keeps every caption with its start and end time, and CaptionTable_fts is an
+FTS5 index of it with external content: it only stores the index and reads
+the text from CaptionTable, so the captions are not stored twice.
+
+The interview's IntCode is indexed too, so the hits of one interview are the
+intersection of its IntCode and the terms in the index, e.g.
+IntCode : "12345" AND Text : ("coffee"), and opening a hit only reads the
+captions around it.
+
+Run in sqlite_db_creation.py, after the WebVTT files are downloaded:
+
+    make_caption_table(db_name, directory)   # for each directory of .vtt files
+    make_caption_fts(db_name)
+"""
+import os
+import sqlite3
+
+hits_per_interview = 5
+window_captions = 10  # Captions shown before and after a hit.
+
+
+def make_caption_table(dbname, directory_path, batch_size=20000):
+    """Generate and populate the table of captions, from a directory of <IntCode>-<TapeNumber>.vtt files."""
+    import webvtt
+    conn = sqlite3.connect(dbname, timeout=10)
+    cursor = conn.cursor()
+    count = 0
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS CaptionTable (
+        CaptionID INTEGER PRIMARY KEY,
+        IntCode INTEGER,
+        TapeNumber INTEGER,
+        CaptionNumber INTEGER,
+        StartTime TEXT,
+        EndTime TEXT,
+        Text TEXT,
+        UNIQUE (IntCode, TapeNumber, CaptionNumber)
+    )
+    ''')
+
+    batch_data = []
+    for filename in os.listdir(directory_path):
+        if count % 2000 == 0:
+            print(f"{count} files processed so far")
+        count += 1
+        split_path = filename.split('-')
+        interview_code = int(split_path[0])
+        tape_number = int(split_path[1].split('.')[0])
+        for number, caption in enumerate(webvtt.read(os.path.join(directory_path, filename)), start=1):
+            text = caption.text.replace("&#39;", "'")
+            batch_data.append((interview_code, tape_number, number, caption.start, caption.end, text))
+
+        if len(batch_data) >= batch_size:
+            cursor.executemany('''
+            INSERT OR REPLACE INTO CaptionTable (IntCode, TapeNumber, CaptionNumber, StartTime, EndTime, Text)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ''', batch_data)
+            conn.commit()
+            batch_data = []
+
+    if batch_data:
+        cursor.executemany('''
+        INSERT OR REPLACE INTO CaptionTable (IntCode, TapeNumber, CaptionNumber, StartTime, EndTime, Text)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ''', batch_data)
+        conn.commit()
+    cursor.close()
+    conn.close()
+
+
+def make_caption_fts(dbname):
+    """Create CaptionTable_fts, the external content FTS5 index of CaptionTable."""
+    conn = sqlite3.connect(dbname, timeout=10)
+    cursor = conn.cursor()
+    cursor.execute("DROP TABLE IF EXISTS CaptionTable_fts;")
+    cursor.execute('''
+    CREATE VIRTUAL TABLE CaptionTable_fts
+    USING fts5(
+        Text,
+        IntCode,
+        content='CaptionTable',
+        content_rowid='CaptionID',
+        tokenize="unicode61 remove_diacritics 1"
+    );
+    ''')
+    cursor.execute("INSERT INTO CaptionTable_fts(CaptionTable_fts) VALUES('rebuild');")
+    cursor.execute("INSERT INTO CaptionTable_fts(CaptionTable_fts) VALUES('optimize');")
+    conn.commit()
+    cursor.execute("PRAGMA optimize;")
+    cursor.close()
+    conn.close()
+
+
+def caption_match(intcode, terms):
+    """FTS5 MATCH expression for the captions of an interview with any of the terms."""
+    terms = ['"' + t.replace('"', '""') + '"' for t in terms]
+    return f'IntCode : "{int(intcode)}" AND Text : ({" OR ".join(terms)})'
+
+
+def caption_hits(cursor, intcode, terms, n=hits_per_interview):
+    """Number of captions of an interview with any of the terms, and the first n of them.
+
+    The hits are dicts with TapeNumber, CaptionNumber, StartTime and Caption (markdown, terms in bold).
+    Raises sqlite3.OperationalError if the database has no CaptionTable_fts.
+    """
+    match = caption_match(intcode, terms)
+    cursor.execute("""
+        SELECT COUNT(*)
+        FROM CaptionTable_fts
+        WHERE CaptionTable_fts MATCH ?
+        ;""", (match,))
+    count = cursor.fetchone()[0]
+    cursor.execute("""
+        SELECT C.TapeNumber, C.CaptionNumber, C.StartTime, highlight(CaptionTable_fts, 0, '**', '**')
+        FROM CaptionTable_fts
+        JOIN CaptionTable C ON C.CaptionID = CaptionTable_fts.rowid
+        WHERE CaptionTable_fts MATCH ?
+        ORDER BY C.TapeNumber, C.CaptionNumber
+        LIMIT ?
+        ;""", (match, n))
+    columns = ['TapeNumber', 'CaptionNumber', 'StartTime', 'Caption']
+    return count, [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+def caption_window(cursor, intcode, tape_number, caption_number, size=window_captions):
+    """The captions (CaptionNumber, StartTime, Text) from size before to size after a caption."""
+    cursor.execute("""
+        SELECT CaptionNumber, StartTime, Text
+        FROM CaptionTable
+        WHERE IntCode = ? AND TapeNumber = ? AND CaptionNumber BETWEEN ? AND ?
+        ORDER BY CaptionNumber
+        ;""", (intcode, tape_number, caption_number - size, caption_number + size))
+    return cursor.fetchall()
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+"""
+In-memory cohort engine for the filter_store query.
+
+Every person in BioTable gets a dense position. For each filter value
+(gender, language, keyword, question/answer pair...) the positions of the
+people that have it are kept as a sorted array, and a filter is evaluated by
+AND/OR-ing the boolean masks built from those arrays.
+"""
+import hashlib
+import json
+import os
+import threading
+import weakref
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from src.funcs import parse_birth_dates
+
+# Questions whose answers are places. Used by the locations filter.
+location_questions = [
+    'Camp(s)',
+    'Ghetto(s)',
+    'Location of Liberation',
+    'Hiding or Living under False Identity (Location)',
+]
+
+yearborn_default = (1892, 1945)
+
+
+def normalise_filter(gend, exp, cntry, lang, key, locations, yearborn, answer, online, testimony):
+    """Turn the raw dropdown values into a canonical filter dict."""
+    if yearborn and tuple(yearborn) != yearborn_default:
+        yearborn = [int(yearborn[0]), int(yearborn[1])]
+    else:
+        yearborn = None
+    return {
+        'gender': gend if gend in ('Male', 'Female') else None,
+        'experience': exp or None,
+        'countries': sorted(set(cntry or [])),
+        'languages': sorted(set(lang or [])),
+        'keywords': sorted({int(k) for k in key or []}),
+        'location': locations or None,
+        'yearborn': yearborn,
+        'answers': sorted({tuple(a.split(': ', 1)) for a in answer or []}),
+        'online': bool(online),
+        'testimony': sorted(set(testimony or [])),
+    }
+
+
+def stored_filter(filt):
+    """Normalise again a filter that went through the browser, so it can't differ from what normalise_filter gives."""
+    return normalise_filter(
+        filt.get('gender'), filt.get('experience'), filt.get('countries'), filt.get('languages'),
+        filt.get('keywords'), filt.get('location'), filt.get('yearborn'),
+        [': '.join(a) for a in filt.get('answers') or []], filt.get('online'), filt.get('testimony'))
+
+
+def cohort_handle(filt):
+    """Short content hash of a normalised filter. Used as the filter_store value."""
+    text = json.dumps(filt, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
+
+
+def testimony_match(terms):
+    """Build the FTS5 MATCH expression for the testimony search terms."""
+    terms = ['"' + t.replace('"', '""') + '"' for t in terms]
+    return f"TapeTestimony : ({' AND '.join(terms)})"
+
+
+def read_keywords_table(conn):
+    """The KeywordsTable columns used by CohortIndex and KeywordMatrix, read once for both."""
+    return pd.read_sql_query("""
+        SELECT PIQPersonID, KeywordID, KeywordLabel, ParentLabel, RootLabel, Latitude
+        FROM KeywordsTable
+        ;""", conn)
+
+
+def person_positions(person_ids, ids):
+    """Map PIQPersonIDs to positions in the sorted person_ids. Unknown IDs map to -1."""
+    ids = np.asarray(ids, dtype=np.int64)
+    if len(person_ids) == 0:
+        return np.full(len(ids), -1, dtype=np.int64)
+    pos = np.searchsorted(person_ids, ids)
+    pos[pos == len(person_ids)] = 0
+    return np.where(person_ids[pos] == ids, pos, -1)
+
+
+def person_mask(person_ids, ids):
+    """Boolean mask over person_ids of the given PIQPersonIDs."""
+    mask = np.zeros(len(person_ids), dtype=bool)
+    pos = person_positions(person_ids, list(ids))
+    mask[pos[pos >= 0]] = True
+    return mask
+
+
+def _postings(keys, positions):
+    """Group person positions by key. Returns {key: sorted unique positions}."""
+    keep = positions >= 0  # people missing from BioTable
+    codes, uniques = pd.factorize(keys[keep])
+    positions = positions[keep]
+    order = np.lexsort((positions, codes))
+    codes = codes[order]
+    positions = positions[order]
+    starts = np.r_[0, np.flatnonzero(np.diff(codes)) + 1]
+    ends = np.r_[starts[1:], len(codes)]
+    postings = {}
+    for s, e in zip(starts, ends):
+        if codes[s] < 0:  # NULL values
+            continue
+        postings[uniques[codes[s]]] = np.unique(positions[s:e]).astype(np.int32)
+    return postings
+
+
+class CohortIndex:
+    """Per-value position lists over BioTable, KeywordsTable and QuestionsTable."""
+
+    bio_columns = ['Gender', 'LanguageLabel', 'ExperienceGroup',
+                   'CountryOfBirth', 'CityOfBirth', 'InVHAOnline']
+
+    def __init__(self, piq_ids, birth_year, birth_date, postings):
+        self.piq_ids = piq_ids
+        self.birth_year = birth_year
+        self.birth_date = birth_date
+        self.postings = postings
+        self.size = len(piq_ids)
+        self._empty = np.empty(0, dtype=np.int32)
+
+    @classmethod
+    def from_connection(cls, conn, keywords=None):
+        """Load the index from an open database connection.
+
+        keywords is the frame of read_keywords_table, if it was read already.
+        """
+        bio = pd.read_sql_query(f"""
+            SELECT PIQPersonID, {', '.join(cls.bio_columns)}, BirthYear, DateOfBirth
+            FROM BioTable
+            ;""", conn)
+        piq_ids = np.unique(bio['PIQPersonID'].to_numpy(dtype=np.int64))
+        position = np.searchsorted(piq_ids, bio['PIQPersonID'].to_numpy(dtype=np.int64))
+
+        # Unknown years become 0 so they never match a range.
+        birth_year = np.zeros(len(piq_ids), dtype=np.int32)
+        birth_year[position] = bio['BirthYear'].fillna(0).to_numpy(dtype=np.int64)
+        birth_date = np.full(len(piq_ids), np.datetime64('NaT'), dtype='datetime64[D]')
+        birth_date[position] = parse_birth_dates(bio['DateOfBirth'])
+
+        postings = {col: _postings(bio[col].to_numpy(dtype=object), position) for col in cls.bio_columns}
+
+        if keywords is None:
+            keywords = read_keywords_table(conn)
+        postings['KeywordID'] = _postings(
+            keywords['KeywordID'].to_numpy(dtype=np.int64),
+            person_positions(piq_ids, keywords['PIQPersonID'].to_numpy(dtype=np.int64)))
+        del keywords
+
+        questions = pd.read_sql_query("""
+            SELECT PIQPersonID, QuestionText, Answer
+            FROM QuestionsTable
+            ;""", conn)
+        qa_keys = np.empty(len(questions), dtype=object)
+        qa_keys[:] = list(zip(questions['QuestionText'], questions['Answer']))
+        qa_positions = person_positions(piq_ids, questions['PIQPersonID'].to_numpy(dtype=np.int64))
+        postings['QuestionAnswer'] = _postings(qa_keys, qa_positions)
+        postings['QuestionText'] = _postings(questions['QuestionText'].to_numpy(dtype=object), qa_positions)
+        del questions
+
+        return cls(piq_ids, birth_year, birth_date, postings)
+
+    def mask(self, column, value):
+        """Boolean mask of the people having value in column."""
+        mask = np.zeros(self.size, dtype=bool)
+        mask[self.postings[column].get(value, self._empty)] = True
+        return mask
+
+    def any_of(self, column, values):
+        """OR of the masks for several values."""
+        mask = np.zeros(self.size, dtype=bool)
+        for value in values:
+            mask[self.postings[column].get(value, self._empty)] = True
+        return mask
+
+    def value_counts(self, column, mask):
+        """Number of people per value of column among the people in mask, in postings order."""
+        return {value: int(np.count_nonzero(mask[positions]))
+                for value, positions in self.postings[column].items()}
+
+    def mask_of_ids(self, ids):
+        """Boolean mask of an arbitrary collection of PIQPersonIDs."""
+        return person_mask(self.piq_ids, ids)
+
+    def evaluate(self, filt, testimony_ids=None):
+        """Return the sorted PIQPersonIDs matching a normalised filter.
+
+        testimony_ids is the result of the full text search, which is not held
+        in memory and has to be queried from TestimonyTable_fts by the caller.
+        """
+        mask = self.any_of('LanguageLabel', filt['languages'])
+        if filt['gender']:
+            mask &= self.mask('Gender', filt['gender'])
+        if filt['experience']:
+            mask &= self.mask('ExperienceGroup', filt['experience'])
+        if filt['countries']:
+            mask &= self.any_of('CountryOfBirth', filt['countries'])
+        if filt['online']:
+            mask &= self.mask('InVHAOnline', 'True')
+        if filt['yearborn']:
+            mask &= (self.birth_year >= filt['yearborn'][0]) & (self.birth_year <= filt['yearborn'][1])
+        for keyword in filt['keywords']:
+            mask &= self.mask('KeywordID', keyword)
+        for question, answer in filt['answers']:
+            mask &= self.mask('QuestionAnswer', (question, answer))
+        if filt['location']:
+            loc = self.mask('CityOfBirth', filt['location'])
+            loc |= self.any_of('QuestionAnswer', [(q, filt['location']) for q in location_questions])
+            mask &= loc
+        if testimony_ids is not None:
+            mask &= self.mask_of_ids(testimony_ids)
+        return self.piq_ids[mask]
+
+
+class CohortRegistry:
+    """Server-side store of computed cohorts, keyed by cohort_handle.
+
+    Recently used cohorts are kept in process. If a shared cache (the
+    flask_caching Cache of the app) is given, cohorts are also written there so
+    other workers can pick them up without recomputing.
+    """
+
+    _instances = weakref.WeakSet()
+
+    def __init__(self, maxsize=128, shared=None, timeout=3600):
+        self.maxsize = maxsize
+        self.shared = shared
+        self.timeout = timeout
+        self._cohorts = OrderedDict()
+        self._lock = threading.Lock()
+        CohortRegistry._instances.add(self)
+
+    def get(self, handle):
+        """Return the PIQ tuple of a handle, or None if it is not stored."""
+        with self._lock:
+            if handle in self._cohorts:
+                self._cohorts.move_to_end(handle)
+                return self._cohorts[handle]
+        if self.shared is not None:
+            ids = self.shared.get(f'cohort:{handle}')
+            if ids is not None:
+                self._remember(handle, ids)
+                return ids
+        return None
+
+    def put(self, handle, ids):
+        """Store the PIQs of a handle."""
+        ids = tuple(ids)
+        self._remember(handle, ids)
+        if self.shared is not None:
+            self.shared.set(f'cohort:{handle}', ids, timeout=self.timeout)
+        return ids
+
+    def _remember(self, handle, ids):
+        with self._lock:
+            self._cohorts[handle] = ids
+            self._cohorts.move_to_end(handle)
+            while len(self._cohorts) > self.maxsize:
+                self._cohorts.popitem(last=False)
+
+    @classmethod
+    def reset_after_fork(cls):
+        """New locks. Run in forked processes, where a lock held by another thread of the parent is never released."""
+        for registry in list(cls._instances):
+            registry._lock = threading.Lock()
+
+
+# Background callbacks run in forked processes (see main.py).
+os.register_at_fork(after_in_child=CohortRegistry.reset_after_fork)
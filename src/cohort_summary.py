@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+One summary per cohort for everything that listens to filter_store.
+
+The map, aggregate graph, question options, data counter, keyword cloud and
+table, and people list all read the same CohortSummary. It is
+computed in one pass the first time any of them asks for a cohort, and kept
+by cohort_handle, so the other callbacks of the same filter change just read
+their part of it.
+"""
+import os
+import threading
+import weakref
+from collections import OrderedDict
+import pandas as pd
+from src.funcs import cohort_param, parse_birth_dates, date_histogram
+from src.cohort import person_mask
+
+# BioTable columns of the aggregate graph (besides DateOfBirth).
+aggregate_columns = ['Gender', 'CountryOfBirth', 'LanguageLabel', 'ExperienceGroup']
+
+birth_cutoff = '1950-12-31'
+birth_max_bins = len(range(1892, 1945))
+
+
+def _value_frame(column, counts):
+    """Aggregate graph dataframe (column, count), most common first, like the GROUP BY query."""
+    df = pd.DataFrame({column: list(counts.keys()), 'count': list(counts.values())})
+    df[column] = df[column].astype(object).where(df[column].notna(), None)
+    df = df[df['count'] > 0].sort_values('count', ascending=False, kind='stable')
+    return df.reset_index(drop=True)
+
+
+class CohortSummary:
+    """Aggregates of one cohort, read by the filter_store callbacks."""
+
+    def __init__(self, ids, mask, value_counts, birth_histogram, questions, keywords):
+        self.ids = ids
+        self.mask = mask  # Over person_ids. The map counts the places of each view with it.
+        self.size = len(ids)
+        self.value_counts = value_counts
+        self.birth_histogram = birth_histogram
+        self.questions = questions
+        self.keywords = keywords
+
+    @classmethod
+    def compute(cls, ids, person_ids, keyword_matrix, index=None, conn=None):
+        """Compute the summary of the PIQs ids.
+
+        The BioTable and QuestionsTable parts come from the CohortIndex if
+        there is one, otherwise from one set of queries on conn.
+        """
+        mask = person_mask(person_ids, ids)
+        if index is not None:
+            value_counts = {}
+            for column in aggregate_columns:
+                counts = index.value_counts(column, mask)
+                missing = len(ids) - sum(counts.values())  # NULLs are a group of their own in SQL.
+                if missing > 0:
+                    counts[None] = missing
+                value_counts[column] = _value_frame(column, counts)
+            dates = index.birth_date[mask]
+            questions = [q for q, count in index.value_counts('QuestionText', mask).items() if count > 0]
+        else:
+            bio = pd.read_sql_query(f"""
+                SELECT {', '.join(aggregate_columns)}, DateOfBirth
+                FROM BioTable
+                WHERE PIQPersonID IN (SELECT value FROM json_each(?))
+                ;""", conn, params=(cohort_param(ids),))
+            value_counts = {column: _value_frame(column, bio[column].value_counts(dropna=False).to_dict())
+                            for column in aggregate_columns}
+            dates = parse_birth_dates(bio['DateOfBirth'])
+            cursor = conn.execute("""
+                SELECT DISTINCT QuestionText
+                FROM QuestionsTable
+                WHERE PIQPersonID IN (SELECT value FROM json_each(?))
+                ;""", (cohort_param(ids),))
+            questions = [r[0] for r in cursor.fetchall()]
+
+        return cls(
+            ids,
+            mask,
+            value_counts,
+            date_histogram(dates, cutoff=birth_cutoff, max_bins=birth_max_bins),
+            questions,
+            keyword_matrix.table(mask),
+        )
+
+
+class SummaryCache:
+    """Cohort summaries by cohort_handle.
+
+    If several callbacks ask for a summary that is not there yet, the first one
+    computes it and the others wait for it instead of computing it again.
+    """
+
+    _instances = weakref.WeakSet()
+
+    def __init__(self, maxsize=16):
+        self.maxsize = maxsize
+        self._summaries = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+        SummaryCache._instances.add(self)
+
+    def get(self, handle, compute):
+        """Return the summary of handle, calling compute() to make it if needed."""
+        with self._lock:
+            if handle in self._summaries:
+                self._summaries.move_to_end(handle)
+                return self._summaries[handle]
+            event = self._pending.get(handle)
+            owner = event is None
+            if owner:
+                event = self._pending[handle] = threading.Event()
+        if not owner:
+            event.wait()
+            with self._lock:
+                summary = self._summaries.get(handle)
+            return summary if summary is not None else self.get(handle, compute)
+
+        try:
+            summary = compute()
+            with self._lock:
+                self._summaries[handle] = summary
+                while len(self._summaries) > self.maxsize:
+                    self._summaries.popitem(last=False)
+        finally:
+            with self._lock:
+                del self._pending[handle]
+            event.set()
+        return summary
+
+    @classmethod
+    def reset_after_fork(cls):
+        """New locks and no pending summaries. Run in forked processes, which only have the thread that forked,
+        so a lock or a pending summary of another thread of the parent would never be released."""
+        for cache in list(cls._instances):
+            cache._lock = threading.Lock()
+            cache._pending = {}
+
+
+# Background callbacks run in forked processes (see main.py).
+os.register_at_fork(after_in_child=SummaryCache.reset_after_fork)
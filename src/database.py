@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Read-only access to the SQLite database used by the dashboard.
+
+The app never writes to the database, so for deployments it can be opened
+with immutable=1: SQLite then skips the file locking and the checks for
+changes by other connections on every statement. With a shared memory
+directory (e.g. /dev/shm) the database is copied there at startup, and every
+worker process maps the same pages from memory instead of each keeping its
+own page cache.
+
+Settings, from environment variables:
+    HNP_DB_IMMUTABLE=1      open the database with immutable=1
+    HNP_DB_SHM=/dev/shm     copy the database to this directory first
+"""
+import os
+import queue
+import shutil
+import sqlite3
+import threading
+
+db_immutable = os.environ.get('HNP_DB_IMMUTABLE', '0') == '1'
+db_shm_dir = os.environ.get('HNP_DB_SHM', '')
+
+
+def shared_memory_copy(db_name, directory):
+    """Copy the database into directory, unless an identical copy is there already. Returns the copy's path.
+
+    Several worker processes can start at once, so the copy is written to a
+    temporary name and renamed into place.
+    """
+    target = os.path.join(directory, os.path.basename(db_name))
+    source_stat = os.stat(db_name)
+    if os.path.exists(target):
+        target_stat = os.stat(target)
+        if (target_stat.st_size, target_stat.st_mtime) == (source_stat.st_size, source_stat.st_mtime):
+            return target
+    temporary = f'{target}.{os.getpid()}.tmp'
+    shutil.copy2(db_name, temporary)
+    os.replace(temporary, target)
+    return target
+
+
+class SQLiteConnection:
+    """Use for database queries.
+
+    Connections are kept open in a pool per database and handed to one `with` block at a time, so
+    SQLite's page cache, memory map and statement cache are kept between callbacks. The PRAGMAs are
+    only run when a connection is opened. The dev server starts a thread per request, so the pool
+    is shared by all threads rather than kept per thread.
+    """
+
+    pragmas = [
+        "PRAGMA synchronous = OFF;",
+        "PRAGMA cache_size = -50000;",
+        "PRAGMA temp_store = MEMORY;",
+        "PRAGMA optimizer_pragmas = 'all';",
+        f"PRAGMA mmap_size = {256 * 1024 * 1024};",
+        "PRAGMA query_only = ON;",
+    ]
+    immutable = db_immutable
+    cached_statements = 256  # Prepared statements kept per connection.
+    max_idle = 8  # Connections kept in the pool. Extra ones are closed when they are returned.
+    _pools = {}
+    _pools_lock = threading.Lock()
+
+    def __init__(self, db_name):
+        self.db_name = db_name
+        with self._pools_lock:
+            self.pool = self._pools.setdefault(db_name, queue.LifoQueue())
+        try:
+            self.conn = self.pool.get_nowait()
+        except queue.Empty:
+            self.conn = self.connect(db_name)
+        self.cursor = self.conn.cursor()
+
+    @classmethod
+    def connect(cls, db_name):
+        """Open a read-only connection and set it up."""
+        uri = f'file:{db_name}?mode=ro'
+        if cls.immutable:
+            uri += '&immutable=1'
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False,
+                               cached_statements=cls.cached_statements)
+        for pragma in cls.pragmas:
+            conn.execute(pragma)
+        return conn
+
+    def __enter__(self):
+        return self.conn, self.cursor
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.cursor.close()
+        if self.conn.in_transaction:
+            self.conn.rollback()
+        if self.pool.qsize() < self.max_idle:
+            self.pool.put(self.conn)
+        else:
+            self.conn.close()
+
+    @classmethod
+    def forget_pools(cls):
+        """Start with empty pools. Run in forked processes, as SQLite connections must not be shared with the parent."""
+        cls._pools = {}
+        cls._pools_lock = threading.Lock()
+
+
+# Background callbacks run in forked processes (see main.py).
+os.register_at_fork(after_in_child=SQLiteConnection.forget_pools)
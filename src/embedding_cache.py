@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+Embedding cache and chunked encoding for the KeyBERT word clouds.
+
+KeyBERT embeds the testimony and every candidate word in it on each call.
+CachedKeyBERT does the same scoring (cosine similarity of each candidate with
+the document, KeyBERT's default without MMR or Max Sum) but:
+
+- keeps the embedding of every candidate word, so words seen in earlier
+  testimonies are not encoded again;
+- keeps document embeddings by (IntCode, TapeNumber);
+- embeds long testimonies in chunks of chunk_words words and averages them,
+  instead of letting the model cut the text off at its maximum length;
+- encodes in batches of batch_size, a good size for CPU inference.
+
+The cache is in memory and, if given a path, also in a separate SQLite file,
+so it lasts between restarts and isn't in the read-only app database. The
+memory part is capped at max_bytes (32 MB, about 20k all-MiniLM-L6-v2
+vectors of 384 float32) per process, as every batch job worker and every
+forked word cloud job has its own copy; the file is the long-term cache. The
+word clouds are extracted in forked background callback processes, whose
+memory is lost when they finish, so there the file is what is shared: each
+process opens its own connection to it.
+"""
+import os
+import sqlite3
+import threading
+import weakref
+from collections import OrderedDict
+import numpy as np
+from sklearn.feature_extraction.text import CountVectorizer
+
+
+class EmbeddingCache:
+    """Embeddings of words and documents, in memory and optionally in a SQLite file."""
+
+    _instances = weakref.WeakSet()
+
+    def __init__(self, path=None, model_name='all-MiniLM-L6-v2', max_bytes=32 * 2**20):
+        self.path = path
+        self.model_name = model_name
+        self.max_bytes = max_bytes
+        self._memory = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._conn = None
+        self._conn_pid = None
+        if path:
+            self.conn.execute("PRAGMA journal_mode = WAL;")
+            self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS Embeddings (
+                Model TEXT,
+                Kind TEXT,
+                Key TEXT,
+                Embedding BLOB,
+                PRIMARY KEY (Model, Kind, Key)
+            ) WITHOUT ROWID
+            ''')
+            self.conn.commit()
+            # Opened again on first use, so a process that forks before using it has nothing open to pass on.
+            self._conn.close()
+            self._conn = self._conn_pid = None
+        EmbeddingCache._instances.add(self)
+
+    @property
+    def conn(self):
+        """Connection to the cache file, or None without one. Opened once per process, as SQLite
+        connections must not be used across a fork."""
+        if self.path and self._conn_pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+            self._conn_pid = os.getpid()
+        return self._conn
+
+    def get_many(self, kind, keys):
+        """Cached embeddings of keys, as {key: vector}. Missing keys are left out."""
+        found = {}
+        with self._lock:
+            for key in keys:
+                if (kind, key) in self._memory:
+                    self._memory.move_to_end((kind, key))
+                    found[key] = self._memory[(kind, key)]
+        missing = [key for key in keys if key not in found]
+        if self.conn is not None and missing:
+            with self._lock:
+                for start in range(0, len(missing), 500):
+                    chunk = missing[start:start + 500]
+                    rows = self.conn.execute(f"""
+                        SELECT Key, Embedding
+                        FROM Embeddings
+                        WHERE Model = ? AND Kind = ? AND Key IN ({', '.join('?' * len(chunk))})
+                        ;""", [self.model_name, kind, *chunk]).fetchall()
+                    for key, blob in rows:
+                        found[key] = np.frombuffer(blob, dtype=np.float32)
+            self._remember(kind, {key: found[key] for key in missing if key in found})
+        return found
+
+    def put_many(self, kind, embeddings):
+        """Store {key: vector}."""
+        embeddings = {key: np.asarray(vector, dtype=np.float32) for key, vector in embeddings.items()}
+        self._remember(kind, embeddings)
+        if self.conn is not None and embeddings:
+            with self._lock:
+                self.conn.executemany('''
+                INSERT OR REPLACE INTO Embeddings (Model, Kind, Key, Embedding)
+                VALUES (?, ?, ?, ?)
+                ''', [(self.model_name, kind, key, vector.tobytes()) for key, vector in embeddings.items()])
+                self.conn.commit()
+
+    def _remember(self, kind, embeddings):
+        with self._lock:
+            for key, vector in embeddings.items():
+                old = self._memory.pop((kind, key), None)
+                if old is not None:
+                    self._bytes -= old.nbytes
+                self._memory[(kind, key)] = vector
+                self._bytes += vector.nbytes
+            while self._bytes > self.max_bytes and self._memory:
+                self._bytes -= self._memory.popitem(last=False)[1].nbytes
+
+    @classmethod
+    def reset_after_fork(cls):
+        """New locks. Run in forked processes, where a lock held by another thread of the parent is never released."""
+        for cache in list(cls._instances):
+            cache._lock = threading.Lock()
+
+
+# The word clouds are extracted in forked background callback processes (see main.py).
+os.register_at_fork(after_in_child=EmbeddingCache.reset_after_fork)
+
+
+def _normalise_rows(vectors):
+    """Scale rows to unit length, so dot products are cosine similarities."""
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class CachedKeyBERT:
+    """KeyBERT keyword extraction with cached embeddings. extract_keywords works like KeyBERT's."""
+
+    def __init__(self, model, cache, chunk_words=150, batch_size=32):
+        self.model = model  # A keybert.KeyBERT; its .model is the embedding backend.
+        self.cache = cache
+        self.chunk_words = chunk_words
+        self.batch_size = batch_size
+
+    def encode(self, texts):
+        """Embed texts in batches of batch_size."""
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+        batches = [self.model.model.embed(texts[start:start + self.batch_size])
+                   for start in range(0, len(texts), self.batch_size)]
+        return np.vstack(batches).astype(np.float32)
+
+    def word_embeddings(self, words):
+        """Embeddings of candidate words, encoding only the ones not in the cache."""
+        found = self.cache.get_many('word', words)
+        missing = [w for w in words if w not in found]
+        if missing:
+            new = dict(zip(missing, self.encode(missing)))
+            self.cache.put_many('word', new)
+            found.update(new)
+        return np.vstack([found[w] for w in words])
+
+    def document_embedding(self, text, key=None):
+        """Mean of the embeddings of the chunk_words long chunks of a text. Cached by key if given."""
+        if key is not None:
+            found = self.cache.get_many('document', [key])
+            if key in found:
+                return found[key]
+        words = text.split()
+        chunks = [' '.join(words[start:start + self.chunk_words])
+                  for start in range(0, len(words), self.chunk_words)] or ['']
+        embedding = _normalise_rows(self.encode(chunks)).mean(axis=0)
+        if key is not None:
+            self.cache.put_many('document', {key: embedding})
+        return embedding
+
+    def extract_keywords(self, docs, top_n=5, stop_words='english', doc_keys=None):
+        """Best top_n (word, score) of each document, like KeyBERT.extract_keywords without MMR."""
+        single = isinstance(docs, str)
+        docs = [docs] if single else list(docs)
+        doc_keys = doc_keys or [None] * len(docs)
+        results = []
+        for doc, key in zip(docs, doc_keys):
+            try:
+                words = CountVectorizer(stop_words=stop_words).fit([doc]).get_feature_names_out().tolist()
+            except ValueError:  # Nothing but stop words.
+                results.append([])
+                continue
+            doc_embedding = _normalise_rows(self.document_embedding(doc, key)[None, :])
+            scores = (_normalise_rows(self.word_embeddings(words)) @ doc_embedding.T).ravel()
+            best = np.argsort(-scores, kind='stable')[:top_n]
+            results.append([(words[i], round(float(scores[i]), 4)) for i in best])
+        return results[0] if single or len(docs) == 1 else results
@@ -4,24 +4,18 @@ Created on Thu Nov 21 20:26:56 2024.
 
 @author: caspe
 """
-import base64
-import zlib
-import pickle
+import json
 import plotly.graph_objects as go
 import numpy as np
 import pandas as pd
 
 
-def unzip_store(filterdata):
-    """Unzips the filter_store data."""
-    filterdata = base64.b64decode(filterdata)
-    filterdata = pickle.loads(zlib.decompress(filterdata))
-    filterdata = tuple(filterdata)
-    if len(filterdata) == 1:
-        filterdata = (filterdata[0], filterdata[0])
-    if len(filterdata) == 0:
-        filterdata = ()
-    return filterdata
+def cohort_param(ids):
+    """Serialise PIQs as one JSON array for binding to `IN (SELECT value FROM json_each(?))`.
+
+    Keeps the query text the same for every cohort, so SQLite's statement cache can reuse it.
+    """
+    return json.dumps([int(i) for i in ids])
 
 
 def normalise(lst, vmax=60, vmin=10):
@@ -37,6 +31,29 @@ def normalise(lst, vmax=60, vmin=10):
     return lst
 
 
+def parse_birth_dates(date_of_birth):
+    """Convert DateOfBirth texts to datetime64[D].
+
+    Only full dates ('%b %d, %Y') are kept. Years alone and months without a
+    day become NaT, and DOBINT is not used: dateparser filled their missing
+    parts with the day the database was built.
+    """
+    dates = pd.to_datetime(pd.Series(date_of_birth, dtype=object), format='%b %d, %Y', errors='coerce')
+    return dates.to_numpy(dtype='datetime64[ns]').astype('datetime64[D]')
+
+
+def date_histogram(dates, cutoff, max_bins):
+    """Bin dates for the date of birth chart. Returns bin starts, bin width and counts."""
+    dates = dates[~np.isnat(dates)]
+    dates = dates[dates <= np.datetime64(cutoff, 'D')]
+    if len(dates) == 0:
+        return dates, np.timedelta64(1, 'D'), np.zeros(0, dtype=np.int64)
+    nbins = max(1, min(len(dates) // 5, max_bins))
+    counts, edges = np.histogram(dates.astype(np.int64), bins=nbins)
+    bin_width = np.timedelta64(max(1, int(edges[1] - edges[0])), 'D')
+    return edges[:-1].astype(np.int64).astype('datetime64[D]'), bin_width, counts
+
+
 def get_batch(lst, batch_size, batch_number):
     """Use for calculating the batch size."""
     start_index = batch_size * (batch_number - 1)
@@ -108,34 +125,59 @@ def remove_trailing_brackets(text):
 #     )
 #     return trace
 
-def generate_trace(filterdata, df, color, answerorkeyword, cluster_bool):
-    """Create trace for map."""
-    if filterdata or filterdata == ():
-        filtered_df = df[df['PIQPersonID'].isin(filterdata)]
-        interntrace_df = filtered_df.groupby([
-            answerorkeyword, 'Latitude', 'Longitude'
-        ]).size().reset_index(name='count').sort_values(by='count', ascending=False)
-        
-    bins = [0, 20, 100, 200, 300, 400, 500, 600, 1000, float('inf')]  # These define the cut-off points
+def marker_points(layer, mask, level, boxes, loaded=()):
+    """Clustered markers of a MapLayer for the cohort mask, as lists ready for a trace or a Patch.
 
-    # Define corresponding labels (must be one less than the number of bins)
-    labels = [20, 50, 100, 200, 300, 400, 500, 600, 1000,]  # The assigned values
+    Covers the tile boxes, leaving out the loaded boxes that are on the map already.
+    """
+    columns = []
+    for i, box in enumerate(boxes):
+        columns.append(layer.clusters(layer.counts(mask, box), level, box, list(loaded) + boxes[:i]))
+    columns = [np.concatenate(c) for c in zip(*columns)]
+    order = np.argsort(-columns[2], kind='stable')
+    lat, lon, counts, places, size, west, south, east, north = (c[order] for c in columns)
 
-    interntrace_df['norm_count'] = pd.cut(interntrace_df['count'], bins=bins, labels=labels, include_lowest=True).astype(int)
+    bins = [20, 100, 200, 300, 400, 500, 600, 1000]  # These define the cut-off points
 
+    # Define corresponding labels (must be one more than the number of cut-off points)
+    labels = np.array([20, 50, 100, 200, 300, 400, 500, 600, 1000])  # The assigned values
+
+    norm_count = labels[np.searchsorted(bins, counts, side='left')]
+
+    # The hovertext stays the place name, as clicking a place puts it in the locations dropdown.
+    # Clicking a cluster zooms to the bounds of its places, which are in customdata with the count.
+    return {
+        'lat': lat.tolist(),
+        'lon': lon.tolist(),
+        'hovertext': layer.labels[places].tolist(),
+        'text': ['' if n == 1 else f' and {n - 1} more places' for n in size],
+        'customdata': np.column_stack([counts, size, west, south, east, north]).tolist(),
+        'size': norm_count.tolist(),
+    }
+
+
+def generate_trace(points, color):
+    """Create trace for map from the output of marker_points."""
     trace = go.Scattermap(
-        lat=interntrace_df["Latitude"],
-        lon=interntrace_df["Longitude"],
-        hovertext=interntrace_df[answerorkeyword],
-        cluster={'enabled': cluster_bool, 'step': 100, 'maxzoom': 5, 'sizesrc': 'marker_size'},
+        lat=points['lat'],
+        lon=points['lon'],
+        hovertext=points['hovertext'],
+        text=points['text'],
         line={'color': 'black', 'width': 1},
         marker={
             'sizemin': 1,
             'sizemode': 'area',
             'color': color,
-            'size': interntrace_df['norm_count'],
+            'size': points['size'],
         },
-        customdata = interntrace_df['count'],
-        hovertemplate="%{hovertext}<br>Count: %{customdata}<extra></extra>",
+        customdata=points['customdata'],
+        hovertemplate="%{hovertext}%{text}<br>Count: %{customdata[0]}<extra></extra>",
     )
-    return trace
\ No newline at end of file
+    return trace
+
+
+def extend_trace(patched_trace, points):
+    """Append the output of marker_points to a trace of a Patch."""
+    for key in ['lat', 'lon', 'hovertext', 'text', 'customdata']:
+        patched_trace[key].extend(points[key])
+    patched_trace['marker']['size'].extend(points['size'])
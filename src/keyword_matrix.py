@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+Sparse person x keyword matrix for the keyword cloud and table.
+
+The non-geographic keywords of KeywordsTable (no coordinates, no stills) are
+loaded once into a CSR matrix with one row per person and one column per
+keyword label, holding the number of KeywordsTable rows. The keyword counts of
+a cohort are then one product of the matrix with the cohort mask.
+"""
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from src.cohort import person_positions, read_keywords_table
+
+
+class KeywordMatrix:
+    """Persons x keyword labels, over the person positions of the cohort index."""
+
+    def __init__(self, matrix, labels):
+        self.matrix = matrix
+        self.labels = labels
+
+    @classmethod
+    def from_connection(cls, conn, person_ids, keywords=None):
+        """Load the matrix from an open database connection.
+
+        keywords is the frame of read_keywords_table, if it was read already.
+        """
+        if keywords is None:
+            keywords = read_keywords_table(conn)
+        stills = keywords['KeywordLabel'].str.lower().str.endswith('(stills)', na=True)  # NOT LIKE '%(stills)'
+        df = keywords[keywords['Latitude'].isna() & ~stills].dropna(subset=['KeywordLabel'])
+        rows = person_positions(person_ids, df['PIQPersonID'].to_numpy(dtype=np.int64))
+        keep = rows >= 0
+        columns, uniques = pd.factorize(df['KeywordLabel'])
+        # Parent and root of the first row of every label, like the GROUP BY of the old query.
+        # factorize numbers the labels in order of first appearance, so the rows line up with the columns.
+        labels = df.drop_duplicates('KeywordLabel')[['KeywordLabel', 'ParentLabel', 'RootLabel']]
+        labels = labels.reset_index(drop=True)
+        matrix = sparse.csr_matrix(
+            (np.ones(keep.sum(), dtype=np.int32), (rows[keep], columns[keep])),
+            shape=(len(person_ids), len(uniques)))
+        matrix.sum_duplicates()
+        return cls(matrix, labels)
+
+    def counts(self, mask=None):
+        """Number of KeywordsTable rows per label for the people in mask. None counts everybody."""
+        if mask is None:
+            return np.asarray(self.matrix.sum(axis=0)).ravel()
+        return self.matrix.T @ mask.astype(np.int32)
+
+    def table(self, mask=None):
+        """KeywordLabel, count, ParentLabel and RootLabel of the labels used by the cohort, most used first."""
+        df = self.labels.assign(count=self.counts(mask))
+        df = df[df['count'] > 0].sort_values('count', ascending=False, kind='stable')
+        return df[['KeywordLabel', 'count', 'ParentLabel', 'RootLabel']].reset_index(drop=True)
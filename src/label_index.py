@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Type-ahead for the place, keyword and question/answer dropdowns.
+
+KeywordsTable and QuestionsTable repeat every label once per person, so a
+LIKE '%search%' over them read millions of rows to find 10 labels. LabelTable
+holds each label once, with the number of people it applies to:
+
+    Kind        'places', 'keywords' or 'answers'
+    Label       shown in the dropdown ('Question: Answer' for answers)
+    Value       value of the dropdown option (KeywordID for keywords, else the label)
+    People      number of people, for ranking
+
+The app loads it into a LabelIndex per kind: the start of every word of every
+label, sorted, so a search is a binary search for the range starting with it.
+A label equal to the search comes first, labels that only contain the search
+inside a word come last, and otherwise the most popular first.
+
+Run from the project root, with write access to the database:
+
+    python -m src.label_index [databases/nov18.db]
+
+Without LabelTable the labels are counted from the big tables at startup,
+which is the slow part this table is there to avoid, so a warning says how to
+build it.
+"""
+import bisect
+import re
+import sqlite3
+import sys
+import time
+import numpy as np
+
+# Distinct labels of each kind, with their value and number of people.
+label_queries = {
+    'places': """
+        SELECT KeywordLabel, KeywordLabel, COUNT(DISTINCT PIQPersonID)
+        FROM KeywordsTable
+        WHERE Latitude IS NOT NULL AND KeywordLabel IS NOT NULL
+        GROUP BY KeywordLabel
+        """,
+    'keywords': """
+        SELECT KeywordLabel, KeywordID, COUNT(DISTINCT PIQPersonID)
+        FROM KeywordsTable
+        WHERE KeywordLabel IS NOT NULL
+        GROUP BY KeywordID, KeywordLabel
+        """,
+    'answers': """
+        SELECT QuestionText || ': ' || Answer, QuestionText || ': ' || Answer, COUNT(DISTINCT PIQPersonID)
+        FROM QuestionsTable
+        WHERE QuestionText IS NOT NULL AND Answer IS NOT NULL
+        GROUP BY QuestionText, Answer
+        """,
+}
+
+
+class LabelIndex:
+    """Distinct labels of a dropdown, searchable by the start of any of their words."""
+
+    def __init__(self, labels, values, people):
+        self.labels = list(labels)
+        self.values = list(values)
+        self.people = np.asarray(people, dtype=np.int64)
+        self.lower = [label.lower() for label in self.labels]
+        self.exact = {}
+        for i, label in enumerate(self.lower):
+            self.exact.setdefault(label, []).append(i)
+        starts = [(i, match.start()) for i, label in enumerate(self.lower) for match in re.finditer(r'\w+', label)]
+        starts.sort(key=lambda start: self.lower[start[0]][start[1]:])
+        self.start_label = np.array([i for i, _ in starts], dtype=np.int64)
+        self.start_offset = np.array([offset for _, offset in starts], dtype=np.int64)
+        # Labels most popular first, then alphabetical, and the position of each label in that order.
+        self.by_rank = np.lexsort((np.array(self.lower, dtype=str), -self.people)) if self.labels else self.people
+        self.rank = np.empty(len(self.labels), dtype=np.int64)
+        self.rank[self.by_rank] = np.arange(len(self.labels))
+        # All labels in one string, best first, to find a search inside words with one scan that can stop early.
+        self.joined = '\n'.join(self.lower[i] for i in self.by_rank)
+        self.joined_starts = np.cumsum([0] + [len(self.lower[i]) + 1 for i in self.by_rank]).tolist()
+
+    @classmethod
+    def from_connection(cls, conn, kind):
+        """Load the labels of a kind from LabelTable, or count them from the big tables without it."""
+        try:
+            rows = conn.execute("""
+                SELECT Label, Value, People
+                FROM LabelTable
+                WHERE Kind = ?
+                ;""", (kind,)).fetchall()
+            problem = f'LabelTable has no {kind}'
+        except sqlite3.OperationalError:  # Database made before LabelTable.
+            rows = []
+            problem = 'The database has no LabelTable'
+        if not rows:
+            print(f'Warning: {problem}, so the {kind} labels are counted from the big tables at every startup, '
+                  'which is slow. Build LabelTable with the label cell of src/sqlite_db_creation.py, '
+                  'or python -m src.label_index <database>.')
+            rows = conn.execute(label_queries[kind]).fetchall()
+        if not rows:
+            return cls([], [], [])
+        return cls(*zip(*rows))
+
+    def _bound(self, text, upper):
+        """First word start (position in start_label) whose text is >= text, or > text if upper."""
+        low, high = 0, len(self.start_label)
+        while low < high:
+            middle = (low + high) // 2
+            offset = self.start_offset[middle]
+            key = self.lower[self.start_label[middle]][offset:offset + len(text)]
+            if key < text or (upper and key == text):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def search(self, text, n=10):
+        """The n best (label, value) for text: equal to it, then with a word starting with it, then containing it."""
+        text = ' '.join((text or '').lower().split())
+        if not text or not self.labels:
+            return []
+        found = self.start_label[self._bound(text, False):self._bound(text, True)]
+        matches = list(self.exact.get(text, []))
+        matches += [i for i in self.by_rank[np.unique(self.rank[found])[:n]] if i not in matches][:n - len(matches)]
+        if len(matches) < n:
+            for match in re.finditer(re.escape(text), self.joined):
+                label = self.by_rank[bisect.bisect_right(self.joined_starts, match.start()) - 1]
+                if label not in matches:
+                    matches.append(label)
+                    if len(matches) == n:
+                        break
+        return [(self.labels[i], self.values[i]) for i in matches]
+
+
+def make_label_table(dbname):
+    """Create LabelTable from KeywordsTable and QuestionsTable."""
+    conn = sqlite3.connect(dbname, timeout=10)
+    cursor = conn.cursor()
+    start = time.time()
+    cursor.execute("DROP TABLE IF EXISTS LabelTable;")
+    cursor.execute('''
+    CREATE TABLE LabelTable (
+        Kind TEXT,
+        Label TEXT,
+        Value,
+        People INTEGER,
+        PRIMARY KEY (Kind, Label, Value)
+    ) WITHOUT ROWID
+    ''')
+    for kind, query in label_queries.items():
+        cursor.execute(f'''
+        INSERT INTO LabelTable (Kind, Label, Value, People)
+        SELECT '{kind}', * FROM ({query})
+        ''')
+        print(f"{cursor.rowcount} {kind} labels")
+    conn.commit()
+    print(f"LabelTable made in {time.time() - start:.1f} seconds")
+    cursor.execute("PRAGMA optimize;")
+    cursor.close()
+    conn.close()
+
+
+if __name__ == "__main__":
+    make_label_table(sys.argv[1] if len(sys.argv) > 1 else 'databases/nov18.db')
@@ -5,64 +5,117 @@ Created on Tue Nov 12 13:37:52 2024.
 @author: caspe
 """
 
-from src.funcs import unzip_store, normalise, get_batch, remove_trailing_brackets, generate_trace
+from src.funcs import (cohort_param, normalise, get_batch, remove_trailing_brackets, generate_trace,
+                       marker_points, extend_trace)
+from src.cohort import (CohortIndex, read_keywords_table, CohortRegistry, normalise_filter, stored_filter, cohort_handle,
+                        testimony_match, location_questions)
+from src.database import SQLiteConnection, shared_memory_copy, db_shm_dir
+from src.keyword_matrix import KeywordMatrix
+from src.cohort_summary import CohortSummary, SummaryCache
+from src.map_layers import (MapLayer, cluster_level, view_bounds, corner_bounds, tile_box,
+                            box_contains, mercator)
+from src.simplify_geojson import lod_tolerances, lod_path, lod_for_zoom
+from src.startup import startup_phase, print_startup_summary, Lazy, ensure_nltk_data, load_startup_frames
+from src.snapshot import read_snapshot
+from src.wordcloud_keywords import keywords_for_texts, lookup_wordcloud, full_interview, wordcloud_table_complete
+from src.name_search import search_names, min_search_length
+from src.label_index import LabelIndex
+from src.testimony_search import search_testimonies, page_size as testimony_page_size
+from src.caption_index import caption_window
+import os
 import math
-import zlib
-import pickle
-import base64
 from flask_caching import Cache
 import sqlite3
+import numpy as np
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
 import dash_bootstrap_components as dbc
-from dash import Dash, html, Input, Output, dcc, State, ctx, ALL, no_update, dash_table
+from dash import Dash, html, Input, Output, dcc, State, ctx, ALL, no_update, dash_table, Patch, DiskcacheManager
+from flask import send_from_directory
 import json
 import gc
 import time
 from dash_holoniq_wordcloud import DashWordcloud
-from dateutil import parser
-from keybert import KeyBERT
-import nltk
-nltk.download('punkt')
-nltk.download('stopwords')
-nltk.download('punkt_tab')
 
 # =============================================================================
 # Loading database, geojson, etc.
 # =============================================================================
 
 db_name = 'databases/nov18.db'
+if db_shm_dir:  # See src/database.py for the deployment settings.
+    db_name = shared_memory_copy(db_name, db_shm_dir)
 
+# The filter_store query is answered from the in-memory CohortIndex. Set to True to also run
+# the SQL query for every filter change and print any difference between the two.
+check_cohort_against_sql = False
 
-with open('maps/map.geojson', mode='r', encoding='utf-8') as f:
-    geojson_data = json.load(f)
-geojson_df = pd.DataFrame([{
-    "NAME": feature["properties"].get("NAME", None),  # Property field in GeoJSON
-    "PART": feature["properties"].get("PARTOF", None),  # Property field in GeoJSON
-    "SUBJ": feature["properties"].get("SUBJECTO", None),  # Property field in GeoJSON
-} for feature in geojson_data['features']])
 
-kw_model = KeyBERT()
+# The geojson is served as a static file (see serve_map_file) and figures reference it by URL,
+# so it is not sent with every figure. Only the properties are needed here.
+# Simplified versions for lower zooms are made by src/simplify_geojson.py.
+maps_dir = os.path.abspath('maps')
+map_lods = {level: tol for level, tol in lod_tolerances.items() if os.path.exists(lod_path(level))}
 
-class SQLiteConnection:
-    """Use for database queries."""
 
-    def __init__(self, db_name):
-        self.db_name = db_name
-        self.conn = sqlite3.connect(f'file:{self.db_name}?mode=ro', uri=True)
-        self.cursor = self.conn.cursor()
-    def __enter__(self):
-        self.cursor.execute("PRAGMA synchronous = OFF;")
-        self.cursor.execute("PRAGMA cache_size = -50000;")
-        self.cursor.execute("PRAGMA temp_store = MEMORY;")
-        self.cursor.execute("PRAGMA optimizer_pragmas = 'all';")
-        return self.conn, self.cursor
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self.cursor.close()
-        self.conn.close()
+def borders_url(zoom):
+    """URL of the borders geojson with the right level of detail for the zoom."""
+    return '/maps/' + os.path.basename(lod_path(lod_for_zoom(zoom, map_lods)))
 
 
+# The properties are read from the smallest file, the coarsest level of detail, which has the same features.
+with startup_phase('geojson'):
+    with open(lod_path(max(map_lods, default=0)), mode='r', encoding='utf-8') as f:
+        geojson_data = json.load(f)
+    geojson_df = pd.DataFrame([{
+        "NAME": feature["properties"].get("NAME", None),  # Property field in GeoJSON
+        "PART": feature["properties"].get("PARTOF", None),  # Property field in GeoJSON
+        "SUBJ": feature["properties"].get("SUBJECTO", None),  # Property field in GeoJSON
+    } for feature in geojson_data['features']])
+    del geojson_data
+
+# The word cloud model and the NLTK data are loaded at startup with background callbacks, else when the
+# first word cloud is made.
+nltk_resources = {
+    'tokenizers/punkt': 'punkt',
+    'corpora/stopwords': 'stopwords',
+    'tokenizers/punkt_tab': 'punkt_tab',
+}
+
+
+# Embeddings of the words and testimonies KeyBERT has seen (src/embedding_cache.py), kept between restarts.
+# Not in cache-directory, whose files flask-caching deletes when it prunes the cache.
+embedding_cache_path = os.path.join('embedding-cache', 'embeddings.db')
+
+
+def load_keybert():
+    """Load the KeyBERT model for the testimony word clouds, with its embedding cache."""
+    ensure_nltk_data(nltk_resources)
+    from keybert import KeyBERT
+    from src.embedding_cache import EmbeddingCache, CachedKeyBERT
+    os.makedirs(os.path.dirname(embedding_cache_path), exist_ok=True)
+    return CachedKeyBERT(KeyBERT(), EmbeddingCache(embedding_cache_path))
+
+
+kw_model = Lazy(load_keybert)
+
+# Word cloud engine: 'keybert' (precomputed in WordcloudTable, or extracted on demand) or 'tfidf'
+# (src/tfidf_keywords.py, needs TermTable, falls back to KeyBERT without it).
+wordcloud_engine = os.environ.get('HNP_WORDCLOUD_ENGINE', 'keybert')
+
+
+def load_tfidf():
+    """Load the idf weights for the TF-IDF word clouds."""
+    from src.tfidf_keywords import TfidfEngine
+    with SQLiteConnection(db_name) as (conn, cursor):
+        engine = TfidfEngine.from_connection(conn)
+    if engine is None:
+        print('No TermTable in the database, using KeyBERT for word clouds')
+    return engine
+
+
+tfidf_engine = Lazy(load_tfidf)
+
 # %% Metadata options for chart 1
 
 aggregate_options = [
@@ -73,32 +126,16 @@ aggregate_options = [
     {'label': 'Experience', 'value': 'ExperienceGroup'},
 ]
 
-# %% Dictionary for Experience Group dropdown.
-with SQLiteConnection(db_name) as (conn, cursor):
-    query = """
-        SELECT ExperienceGroup, COUNT(DISTINCT PIQPersonID) as count
-        FROM BioTable
-        GROUP BY ExperienceGroup
-        ORDER BY count DESC
-    ;"""
-    cursor.execute(query,)
-    exp_group_list = cursor.fetchall()
+# %% Startup dataframes, from the snapshot if it is up to date (see src/snapshot.py), else from SQL.
+with startup_phase('startup dataframes'):
+    startup_frames = read_snapshot(db_name)
+    if startup_frames is None:
+        startup_frames = load_startup_frames(db_name)
 
+exp_group_list = list(startup_frames['exp_group'].itertuples(index=False, name=None))
 exp_group_listdict = [{"label": f"{tup[0]}, {tup[1]} entries", "value": tup[0]} for tup in exp_group_list]
 
-
-# %% Table that accompanies tag cloud. Filled with dummy data here.
-with SQLiteConnection(db_name) as (conn, cursor):
-    query = """
-    SELECT DISTINCT KeywordLabel, COUNT(*) as count, ParentLabel, RootLabel
-    FROM KeywordsTable
-    GROUP BY KeywordLabel
-    ORDER BY count DESC
-    LIMIT 20
-    ;
-    """
-    datatable_alldata_df = pd.read_sql_query(query, conn)
-
+datatable_alldata_df = startup_frames['datatable_alldata']
 global_table = dash_table.DataTable(
         id='datatable',
         columns=[{"name": i, "id": i} for i in datatable_alldata_df.columns],
@@ -123,154 +160,64 @@ global_table = dash_table.DataTable(
             'fontWeight': 'bold'
         },
 )
-# %% birthplaces dataframe. Used for map.
-with SQLiteConnection(db_name) as (conn, cursor):
-    query = """
-    SELECT DISTINCT
-        BioTable.PIQPersonID,
-        Subquery.KeywordLabel,
-        BioTable.CityOfBirth,
-        Subquery.Latitude,
-        Subquery.Longitude
-    FROM BioTable
-    LEFT JOIN (
-        SELECT DISTINCT
-            KeywordLabel,
-            Latitude,
-            Longitude
-        FROM KeywordsTable
-        WHERE Latitude IS NOT NULL
-    ) AS Subquery
-    ON BioTable.CityOfBirth = Subquery.KeywordLabel
-    """
-    birth_df_raw = pd.read_sql_query(query, conn)
-
-birth_df = birth_df_raw.groupby([
-    'KeywordLabel', 'Latitude', 'Longitude'
-]).size().reset_index(name='count').sort_values(by='count', ascending=False)
-# %% Getting all locations, and function for getting answers.
-
-with SQLiteConnection(db_name) as (conn, cursor):
-    query = """
-    SELECT DISTINCT
-        KeywordsTable.KeywordLabel, KeywordsTable.Latitude, KeywordsTable.Longitude
-    FROM KeywordsTable
-    WHERE
-        KeywordsTable.Latitude IS NOT NULL
-    AND
-        KeywordsTable.Longitude IS NOT NULL
-    ;
-    """
-    coordinates_df = pd.read_sql_query(query, conn)
-
-
-def get_answer(q):
-    """Use for counting answers by question."""
-    with SQLiteConnection(db_name) as (conn, cursor):
-        query = f"""
-            SELECT DISTINCT PIQPersonID, Answer
-            FROM QuestionsTable
-            WHERE QuestionText = '{q}'
-        ;
-        """
-        df = pd.read_sql_query(query, conn)
-    return df
-# %% Hiding place locations
 
-def get_coords_byquestion(question):
-    """Get the coordinates of keywords depending on the question input."""
+birth_df_raw = startup_frames['birth']
+coordinates_df = startup_frames['coordinates']
+hiding_df = startup_frames['hiding']
+liberation_df = startup_frames['liberation']
+ghettos_df = startup_frames['ghettos']
+allcamps_df = startup_frames['allcamps']
+deathcamps_df = startup_frames['deathcamps']
+concamps_df = startup_frames['concamps']
+interncamps_df = startup_frames['interncamps']
+powcamps_df = startup_frames['powcamps']
+countries = startup_frames['countries']["CountryOfBirth"].tolist()
+
+# %% KeywordsTable, the biggest table, is read once for the cohort index and the keyword matrix.
+with startup_phase('keywords table'), SQLiteConnection(db_name) as (conn, cursor):
+    keywords_df = read_keywords_table(conn)
+
+# %% Cohort index for the filter_store query. Falls back to SQL if it can't be built.
+try:
+    with startup_phase('cohort index'), SQLiteConnection(db_name) as (conn, cursor):
+        cohort_index = CohortIndex.from_connection(conn, keywords_df)
+        print(f'Cohort index with {cohort_index.size} people')
+except (sqlite3.Error, pd.errors.DatabaseError, MemoryError) as e:
+    print(f'Could not build cohort index, using SQL for filters: {e}')
+    cohort_index = None
+
+# %% Map layers compiled to (person, place) arrays over the same person positions as the cohort index.
+if cohort_index is not None:
+    person_ids = cohort_index.piq_ids
+else:
     with SQLiteConnection(db_name) as (conn, cursor):
-        query = f"""
-            SELECT DISTINCT Q.PIQPersonID, Answer, Latitude, Longitude
-            FROM QuestionsTable Q
-            LEFT JOIN KeywordsTable K ON Answer = KeywordLabel
-            WHERE
-                Latitude IS NOT NULL
-                AND QuestionText = '{question}'
-        ;
-        """
-        return pd.read_sql_query(query, conn)
-
-
-hiding_df = get_coords_byquestion('Hiding or Living under False Identity (Location)')
-hiding_df_grouped = hiding_df.groupby([
-    'Answer', 'Latitude', 'Longitude'
-]).size().reset_index(name='count').sort_values(by='count', ascending=False)
-
-
-# %% liberation location
+        cursor.execute("SELECT DISTINCT PIQPersonID FROM BioTable ORDER BY PIQPersonID;")
+        person_ids = np.array([r[0] for r in cursor.fetchall()], dtype=np.int64)
+
+with startup_phase('map layers'):
+    map_layers = {
+        'birth': MapLayer.from_frame(birth_df_raw, 'KeywordLabel', person_ids),
+        'intern': MapLayer.from_frame(interncamps_df, 'Answer', person_ids),
+        'pow': MapLayer.from_frame(powcamps_df, 'Answer', person_ids),
+        'ghetto': MapLayer.from_frame(ghettos_df, 'Answer', person_ids),
+        'concen': MapLayer.from_frame(concamps_df, 'Answer', person_ids),
+        'death': MapLayer.from_frame(deathcamps_df, 'Answer', person_ids),
+        'liber': MapLayer.from_frame(liberation_df, 'Answer', person_ids),
+        'hiding': MapLayer.from_frame(hiding_df, 'Answer', person_ids),
+    }
 
+total_people = len(person_ids)
 
-liberation_df = get_answer('Location of Liberation')
-liberation_df = pd.merge(
-                    liberation_df,
-                    coordinates_df,
-                    left_on='Answer',
-                    right_on='KeywordLabel',
-                    how='left'
-                    )
-liberation_df = liberation_df.dropna()
-
-liberation_df_grouped = liberation_df.groupby([
-    'Answer', 'Latitude', 'Longitude'
-]).size().reset_index(name='count').sort_values(by='count', ascending=False)
-
-# %% Ghettos
-
-ghettos_df = get_answer("Ghetto(s)")
-ghettos_df = pd.merge(ghettos_df, coordinates_df,
-                      left_on='Answer',
-                      right_on='KeywordLabel',
-                      how='left')
-ghettos_df = ghettos_df.dropna()
-
-ghettos_df_grouped = ghettos_df.groupby([
-    'Answer', 'Latitude', 'Longitude'
-]).size().reset_index(name='count').sort_values(by='count', ascending=False)
-# %% camps
-# Same as above but for all camps which will then be segmented further.
-allcamps_df = get_answer("Camp(s)")
-allcamps_df = pd.merge(allcamps_df, coordinates_df,
-                       left_on='Answer',
-                       right_on='KeywordLabel',
-                       how='left')
-allcamps_df = allcamps_df.dropna()
-
-# camp types?
-deathcamps_df = allcamps_df[allcamps_df["KeywordLabel"].str.contains(
-    "Death Camp", na=False, case=False)]
-concamps_df = allcamps_df[allcamps_df["KeywordLabel"].str.contains(
-    r"Concentration Camp|Concentation Camp", na=False, case=False)]
-interncamps_df = allcamps_df[allcamps_df["KeywordLabel"].str.contains(
-    r"Internment Camp|internment Camp", na=False, case=False)]
-powcamps_df = allcamps_df[allcamps_df["KeywordLabel"].str.contains(
-    r"POW Camp|POW", na=False, case=False)]
-
-
-deathcamps_df_grouped = deathcamps_df.groupby([
-    'Answer', 'Latitude', 'Longitude'
-]).size().reset_index(name='count').sort_values(by='count', ascending=False)
-
-concamps_df_grouped = concamps_df.groupby([
-    'Answer', 'Latitude', 'Longitude'
-]).size().reset_index(name='count').sort_values(by='count', ascending=False)
-
-interncamps_df_grouped = interncamps_df.groupby([
-    'Answer', 'Latitude', 'Longitude'
-]).size().reset_index(name='count').sort_values(by='count', ascending=False)
-
-powcamps_df_grouped = powcamps_df.groupby([
-    'Answer', 'Latitude', 'Longitude'
-]).size().reset_index(name='count').sort_values(by='count', ascending=False)
+# %% Person x keyword matrix for the keyword cloud and table.
+with startup_phase('keyword matrix'), SQLiteConnection(db_name) as (conn, cursor):
+    keyword_matrix = KeywordMatrix.from_connection(conn, person_ids, keywords_df)
+del keywords_df
 
-# %%
-with SQLiteConnection(db_name) as (conn, cursor):
-    query = """
-    SELECT DISTINCT CountryOfBirth
-    FROM BioTable
-    ;"""
-    countries = pd.read_sql_query(query, conn).dropna()
-countries = countries["CountryOfBirth"].tolist()
+# %% Distinct labels for the type-ahead of the place, keyword and answer dropdowns.
+with startup_phase('label indexes'), SQLiteConnection(db_name) as (conn, cursor):
+    place_labels = LabelIndex.from_connection(conn, 'places')
+    keyword_labels = LabelIndex.from_connection(conn, 'keywords')
+    answer_labels = LabelIndex.from_connection(conn, 'answers')
 
 
 # %%
@@ -291,6 +238,18 @@ colors = px.colors.qualitative.Dark2
 
 b1_col, b2_col, b3_col, b4_col, b5_col, b6_col, b7_col, b8_col = colors
 
+# Map layer buttons in the order of their traces on the map (trace 0 is the borders).
+map_layer_buttons = [
+    ('birth', b1_col),
+    ('intern', b2_col),
+    ('pow', b3_col),
+    ('ghetto', b4_col),
+    ('concen', b5_col),
+    ('death', b6_col),
+    ('liber', b7_col),
+    ('hiding', b8_col),
+]
+
 accordion_style = {
     'backgroundColor': color_scheme, 'borderColor': color_scheme}
 
@@ -313,8 +272,34 @@ spinnerstyle = {'height': '10rem', 'width': '10rem'}
 
 # %%
 
+# The word cloud is a background callback, as KeyBERT can take seconds: each call runs in its own process
+# and the browser polls for the result, so it doesn't hold a web server thread. A call still running when
+# its inputs change again is terminated. Needs dash[diskcache]; without it it runs as a normal callback.
+# The other callbacks take milliseconds and stay normal callbacks, forking for them would be slower.
+try:
+    import diskcache
+    background_manager = DiskcacheManager(diskcache.Cache('background-cache'))
+except ImportError:
+    background_manager = None
+run_in_background = background_manager is not None
+
+# The word cloud jobs are forked from this process and inherit what is loaded here, instead of each
+# loading the idf weights or the KeyBERT model again. KeyBERT is only loaded here if some testimonies
+# are missing from WordcloudTable, so a job may need it. Otherwise it loads on first use.
+if wordcloud_engine == 'tfidf':
+    with startup_phase('tfidf engine'):
+        tfidf_engine.get()
+if run_in_background and (wordcloud_engine != 'tfidf' or tfidf_engine.get() is None):
+    with startup_phase('wordcloud table check'):
+        with SQLiteConnection(db_name) as (conn, cursor):
+            preload_keybert = not wordcloud_table_complete(cursor)
+    if preload_keybert:
+        with startup_phase('keybert'):
+            kw_model.get()
+
 app = Dash(__name__,
            suppress_callback_exceptions=True,
+           background_callback_manager=background_manager,
            external_stylesheets=[dbc.themes.LUX, dbc.icons.BOOTSTRAP],
            meta_tags=[
                {"name": "viewport", "content": "width=device-width, initial-scale=1"},
@@ -323,12 +308,94 @@ app = Dash(__name__,
 
 server = app.server
 
+
+@server.route('/maps/<path:filename>')
+def serve_map_file(filename):
+    """Serve the geojson files, so the browser downloads and caches them once."""
+    return send_from_directory(maps_dir, filename, max_age=7 * 24 * 3600)
+
+
+# After this many tile boxes the map is redrawn for the current view only, so it doesn't keep growing.
+max_tile_boxes = 8
+
+
+def map_tiles(level, bounds):
+    """Contents of map_tiles_store: the cluster level and the boxes of map cells sent to the browser."""
+    return {'level': level, 'boxes': [tile_box(bounds, level)]}
+
+
+def map_view(relayout):
+    """Cluster level and bounds of the view after a pan or zoom, or None if the view did not change."""
+    if not relayout or 'map.zoom' not in relayout:
+        return None
+    zoom = relayout['map.zoom']
+    derived = relayout.get('map._derived', {})
+    if 'coordinates' in derived:
+        bounds = corner_bounds(derived['coordinates'])
+    else:
+        bounds = view_bounds(relayout['map.center'], zoom)
+    return cluster_level(zoom), bounds
+
+
+def is_cluster(click):
+    """Whether a map click is on a marker of several places (see marker_points)."""
+    customdata = click['points'][0].get('customdata')
+    return isinstance(customdata, list) and customdata[1] > 1
+
+
+def cluster_relayout(click, level, width=1600, height=900, max_zoom=12):
+    """Center and zoom fitting the places of a clicked cluster, in the form of relayoutData.
+
+    At least one zoom level further than the current cluster level, so the cluster splits.
+    """
+    _, _, west, south, east, north = click['points'][0]['customdata']
+    x0, y1 = mercator(south, west)
+    x1, y0 = mercator(north, east)
+    fit = math.log2(min(width / max((x1 - x0) * 512, 1e-9), height / max((y1 - y0) * 512, 1e-9))) - 0.2
+    zoom = float(min(max(fit, level + 1), max_zoom))
+    return {'map.center': {'lat': (south + north) / 2, 'lon': (west + east) / 2}, 'map.zoom': zoom}
+
+
+def base_map_figure():
+    """Make the initial map: the borders layer, then one empty slot per point layer button."""
+    fig = go.Figure(go.Choroplethmap(
+        geojson=borders_url(3.7),
+        locations=geojson_df['NAME'],
+        z=[1]*len(geojson_df),
+        featureidkey="properties.NAME",
+        colorscale=[[0, 'rgba(0, 0, 0, 0)'], [1, 'rgba(0, 0, 0, 0)']],
+        hoverinfo='skip',
+        marker={'opacity': .5},
+        marker_line_width=1.5,
+        marker_line_color='black',
+        showscale=False,
+    ))
+    for _ in map_layer_buttons:
+        fig.add_trace(go.Scattermap(lat=[], lon=[], hoverinfo='skip'))
+
+    fig.update_layout(
+        map_style='carto-voyager-nolabels',
+        map_center={'lat': 49, 'lon': 15},
+        map_zoom=3.7,
+        margin=dict(
+            l=0,
+            r=0,
+            t=0,
+            b=0
+        ),
+        showlegend=False,
+    )
+    return fig
+
 cache = Cache(app.server, config={
     'CACHE_TYPE': 'filesystem',
     'CACHE_DIR': 'cache-directory',
     'CACHE_DEFAULT_TIMEOUT': 300
 })
 
+cohort_registry = CohortRegistry(shared=cache)
+summary_cache = SummaryCache()
+
 
 @cache.memoize()    # Saves some of the results. Helps speed up common queries that are a little slow.
 def data_query(yb, li, ki, ai, ti, lang, gend, exp, cntry, online):
@@ -355,6 +422,8 @@ def data_query(yb, li, ki, ai, ti, lang, gend, exp, cntry, online):
 
 app.layout = dbc.Container([
     dcc.Store(id='selected_piq_store'),
+    dcc.Store(id='map_lod_store', data=borders_url(3.7)),
+    dcc.Store(id='map_tiles_store', data=map_tiles(cluster_level(3.7), view_bounds({'lat': 49, 'lon': 15}, 3.7))),
     dbc.Offcanvas(
             html.Div([
                 html.Div(id="testimony_selectors"),
@@ -396,6 +465,13 @@ app.layout = dbc.Container([
             is_open=False,
             style={'width': '83vw', 'backgroundColor': color_scheme}
         ),
+    dbc.Modal([
+        dbc.ModalHeader(dbc.ModalTitle("Testimonies ranked by the search terms")),
+        dbc.ModalBody(dbc.Spinner(html.Div(id='testimony_search_results'))),
+        dbc.ModalFooter(
+            dbc.Pagination(id='testimony_search_pagination', max_value=1, active_page=1, size="sm",
+                           fully_expanded=False, previous_next=True)),
+        ], id='testimony_search_modal', size='xl', scrollable=True, is_open=False),
     dbc.Row([
         dbc.Col([
             dbc.Row(
@@ -585,7 +661,11 @@ app.layout = dbc.Container([
                             dbc.Tooltip("""Use the above input bar to search for terms
                                         within the testimonies. Try something broad, like 'coffee',
                                         or something more specific.
-                                        """, target='testimony_dd')
+                                        """, target='testimony_dd'),
+                            dbc.Button('Ranked passages', id='testimony_search_button', n_clicks=0, size='sm'),
+                            dbc.Tooltip("""See the testimonies of the selection that best match the search
+                                        terms, with the passages and the parts they are in.
+                                        """, target='testimony_search_button'),
                             ])
                         ], direction='horizontal', gap=1),
                     ], gap=2, direction='vertical', style={'height': '100vh', 'overflowY': 'auto'}),
@@ -612,6 +692,7 @@ app.layout = dbc.Container([
                                  'color': 'black'}
                           ),
                 dcc.Graph(id="map",
+                          figure=base_map_figure(),
                           style={'height': '100%', 'width': '100%',
                                  'margin': 0, 'padding': 0,
                                  'backgroundColor': color_scheme},
@@ -738,105 +819,148 @@ app.layout = dbc.Container([
     Input('testimony_dd', 'value'),
 )
 def storing_func(gend, exp, cntry, lang, key, locations, yearborn, answer, online, testimony):
-    """Use for storing query results (PIQ) for use in other components."""
-    start = time.time()
-    if yearborn:
-        if yearborn[0] == 1892 and yearborn[1] == 1945:
-            yearborn = ""
+    """Use for storing query results (PIQ) for use in other components.
+
+    Only a handle to the cohort goes to the browser. The PIQs are kept in cohort_registry.
+    """
+    filt = normalise_filter(gend, exp, cntry, lang, key, locations, yearborn, answer, online, testimony)
+    handle = cohort_handle(filt)
+    if cohort_registry.get(handle) is None:
+        cohort_registry.put(handle, compute_cohort(filt))
+    return {'handle': handle, 'filter': filt}
+
+
+def checked_store(store):
+    """The filter_store with the handle recomputed from its filter.
+
+    The store comes back from the browser, and the cohorts are cached and shared by handle, so a handle
+    sent with another filter must not be trusted.
+    """
+    filt = stored_filter(store['filter'])
+    handle = cohort_handle(filt)
+    if handle != store['handle']:
+        print(f"filter_store handle {store['handle']!r} doesn't match its filter, using {handle!r}")
+    return {'handle': handle, 'filter': filt}
+
+
+def get_cohort(store):
+    """Get the PIQs of the filter_store, recomputing them if the cohort was evicted."""
+    store = checked_store(store)
+    ids = cohort_registry.get(store['handle'])
+    if ids is None:
+        ids = cohort_registry.put(store['handle'], compute_cohort(store['filter']))
+    return ids
+
+
+def cohort_summary(store):
+    """Get the CohortSummary of the filter_store. It is computed once per cohort and shared by the callbacks."""
+    store = checked_store(store)
+
+    def compute():
+        start = time.time()
+        ids = get_cohort(store)
+        if cohort_index is not None:
+            summary = CohortSummary.compute(ids, person_ids, keyword_matrix, index=cohort_index)
         else:
-            yb_list = [f"DateOfBirth LIKE '%{year}%'" for year in range(yearborn[0], yearborn[1], 1)]
-            yearborn = 'SELECT PIQPersonID FROM BioTable WHERE ' + ' OR '.join(yb_list) + ' INTERSECT'
+            with SQLiteConnection(db_name) as (conn, cursor):
+                summary = CohortSummary.compute(ids, person_ids, keyword_matrix, conn=conn)
+        print(f'Cohort summary took {time.time() - start:.4f} seconds')
+        return summary
+    return summary_cache.get(store['handle'], compute)
+
+
+def compute_cohort(filt):
+    """Get the PIQs matching a normalised filter."""
+    start = time.time()
+    if cohort_index is not None:
+        testimony_ids = testimony_query(filt['testimony']) if filt['testimony'] else None
+        results = cohort_index.evaluate(filt, testimony_ids).tolist()
+        print(f'filter_store callback took {time.time() - start:.4f} seconds (cohort index)')
+        if check_cohort_against_sql:
+            expected = sorted(query_cohort_sql(filt))
+            if expected != results:
+                print(f'Cohort index mismatch: {len(results)} vs {len(expected)} from SQL for {filt}')
+    else:
+        results = query_cohort_sql(filt)
+        print(f'filter_store callback took {time.time() - start:.2f} seconds')
+    gc.collect()
+    return results
+
+
+def testimony_query(terms):
+    """Get the PIQs whose testimonies contain all the search terms."""
+    with SQLiteConnection(db_name) as (conn, cursor):
+        cursor.execute("""
+            SELECT PIQPersonID
+            FROM TestimonyTable_fts
+            WHERE TestimonyTable_fts MATCH ?
+            ;""", (testimony_match(terms),))
+        return [r[0] for r in cursor.fetchall()]
+
+
+def query_cohort_sql(filt):
+    """Run a normalised filter through the SQL INTERSECT chain. Used as fallback for the cohort index."""
+    if filt['yearborn']:
+        first, last = filt['yearborn']
+        yearborn = f'SELECT PIQPersonID FROM BioTable WHERE BirthYear BETWEEN {first:d} AND {last:d} INTERSECT'
     else:
         yearborn = ""
 
-    if testimony:
-        if len(testimony) > 1:
-            testimony = [f'"{t}"' for t in testimony]
-            testimony = ' AND '.join(testimony)
-            testimony_intersect = f"""
-                SELECT PIQPersonID
-                FROM TestimonyTable_fts
-                WHERE TestimonyTable_fts MATCH '{testimony}'
-                INTERSECT
-            """
-        else:
-            testimony_intersect = f"""
-                SELECT PIQPersonID
-                FROM TestimonyTable_fts
-                WHERE TapeTestimony MATCH '"{testimony[0]}"'
-                INTERSECT
-            """
+    if filt['testimony']:
+        testimony = testimony_match(filt['testimony']).replace("'", "''")
+        testimony_intersect = f"""
+            SELECT PIQPersonID
+            FROM TestimonyTable_fts
+            WHERE TestimonyTable_fts MATCH '{testimony}'
+            INTERSECT
+        """
     else:
         testimony_intersect = ''
 
-    if online:
+    if filt['online']:
         online = " AND InVHAOnline = 'True'"
     else:
         online = ""
 
     answer_intersect = ""
-    if answer:
-        answer = [f"""QuestionText = '{a.split(': ', 1)[0]}' AND Answer = "{a.split(': ', 1)[1]}" """ for a in answer]
-        if len(answer) > 1:
-            answer = [f'SELECT PIQPersonID FROM QuestionsTable WHERE {a}' for a in answer]
-            answer_intersect = " INTERSECT ".join(answer) + ' INTERSECT '
-        else:
-            answer = answer[0]
-            answer_intersect = f"""
-                SELECT PIQPersonID
-                FROM QuestionsTable
-                WHERE {answer}
-            INTERSECT
-            """
-    locations_intersect = ""
+    if filt['answers']:
+        answer = [f"""QuestionText = '{q}' AND Answer = "{a}" """ for q, a in filt['answers']]
+        answer = [f'SELECT PIQPersonID FROM QuestionsTable WHERE {a}' for a in answer]
+        answer_intersect = " INTERSECT ".join(answer) + ' INTERSECT '
 
-    if locations:
-        locations_intersect = f"""
-            SELECT PIQPersonID
-            FROM QuestionsTable
-            WHERE
-                QuestionText = 'Camp(s)'
-                AND Answer = "{locations}"
-            UNION
+    locations_intersect = ""
+    if filt['location']:
+        locations = filt['location']
+        loc_list = [f"""
             SELECT PIQPersonID
             FROM QuestionsTable
             WHERE
-                QuestionText = 'Ghetto(s)'
+                QuestionText = '{q}'
                 AND Answer = "{locations}"
-
-            UNION
-
+            """ for q in location_questions]
+        loc_list.append(f"""
             SELECT PIQPersonID
             FROM BioTable
             WHERE CityOfBirth = "{locations}"
-
-            UNION
-
-            SELECT PIQPersonID
-            FROM QuestionsTable
-            WHERE
-                QuestionText = 'Location of Liberation'
-                AND Answer = "{locations}"
-            UNION
-
-            SELECT PIQPersonID
-            FROM QuestionsTable
-            WHERE
-                QuestionText = 'Hiding or Living under False Identity (Location)'
-                AND Answer = "{locations}"
-
+            """)
+        # Wrapped in a subquery, otherwise the UNIONs would be applied after the year INTERSECT.
+        locations_intersect = f"""
+            SELECT PIQPersonID FROM ({" UNION ".join(loc_list)})
             INTERSECT
         """
 
-    if gend == 'Male' or gend == 'Female':
-        gend = f" AND Gender = '{gend}'"
+    if filt['gender']:
+        gend = f" AND Gender = '{filt['gender']}'"
     else:
         gend = ""
 
+    exp = filt['experience']
     if exp:
         exp = f' AND ExperienceGroup = "{exp}"'
     else:
         exp = ""
+
+    cntry = filt['countries']
     if cntry:
         if len(cntry) == 1:
             cntry = f" AND CountryOfBirth IN ('{cntry[0]}')"
@@ -844,6 +968,8 @@ def storing_func(gend, exp, cntry, lang, key, locations, yearborn, answer, onlin
             cntry = f" AND CountryOfBirth IN {tuple(cntry)}"
     else:
         cntry = ""
+
+    lang = filt['languages']
     if lang:
         if len(lang) > 1:
             lang = tuple(lang)
@@ -852,33 +978,16 @@ def storing_func(gend, exp, cntry, lang, key, locations, yearborn, answer, onlin
     else:
         lang = "() "
 
-    if key:
-        key = [f"""KeywordID = "{k}" """ for k in key]
-        if len(key) > 1:
-            key = [f'SELECT PIQPersonID FROM KeywordsTable WHERE {k}' for k in key]
-            keyword_intersect = " INTERSECT ".join(key) + ' INTERSECT '
-        else:
-            key = key[0]
-            keyword_intersect = f"""
-                SELECT PIQPersonID
-                FROM KeywordsTable
-                WHERE {key}
-            INTERSECT
-            """
-    else:
-        keyword_intersect = ""
-    start = time.time()
+    keyword_intersect = ""
+    if filt['keywords']:
+        key = [f'SELECT PIQPersonID FROM KeywordsTable WHERE KeywordID = {k}' for k in filt['keywords']]
+        keyword_intersect = " INTERSECT ".join(key) + ' INTERSECT '
+
     results = data_query(
         yearborn, locations_intersect, keyword_intersect,
         answer_intersect, testimony_intersect,
         lang, gend, exp, cntry, online)
-    print(f'filter_store callback took {time.time() - start:.2f} seconds')
-    results = [r[0] for r in results]
-
-    results = zlib.compress(pickle.dumps(results))
-    results = base64.b64encode(results).decode('utf-8')
-    gc.collect()
-    return results
+    return [r[0] for r in results]
 
 
 @app.callback(
@@ -894,7 +1003,7 @@ def generate_questionnaire_graph(someinput, quest, agg_val, agg_fig):
     if agg_fig is None:
         return no_update
     if someinput and agg_fig:
-        someinput = unzip_store(someinput)
+        someinput = cohort_param(get_cohort(someinput))
         with SQLiteConnection(db_name) as (conn, cursor):
             if agg_val != 'DateOfBirth':
                 query = f"""
@@ -902,18 +1011,18 @@ def generate_questionnaire_graph(someinput, quest, agg_val, agg_fig):
                         FROM QuestionsTable Q
                         LEFT JOIN BioTable B
                         ON Q.PIQPersonID = B.PIQPersonID
-                        WHERE QuestionText = '{quest}' AND Q.PIQPersonID IN {someinput}
+                        WHERE QuestionText = ? AND Q.PIQPersonID IN (SELECT value FROM json_each(?))
                         GROUP BY Answer, {agg_val}
                         ;"""
             else:
                 agg_val = 'Answer'
-                query = f"""
+                query = """
                         SELECT Answer, COUNT(*) AS count
                         FROM QuestionsTable
-                        WHERE QuestionText = '{quest}' AND PIQPersonID IN {someinput}
+                        WHERE QuestionText = ? AND PIQPersonID IN (SELECT value FROM json_each(?))
                         GROUP BY Answer
                         ;"""
-            df = pd.read_sql_query(query, conn)
+            df = pd.read_sql_query(query, conn, params=(quest, someinput))
 
         if agg_fig['data'][0]['marker']['color'] != color_scheme_secondary:
             colors = {trace['name']: trace['marker']['color'] for trace in agg_fig['data']}
@@ -963,6 +1072,8 @@ def generate_questionnaire_graph(someinput, quest, agg_val, agg_fig):
 
 @app.callback(
     Output("map", "figure"),
+    Output('map_tiles_store', 'data'),
+    Output('map_lod_store', 'data', allow_duplicate=True),
     Input('birth', 'n_clicks'),
     Input('intern', 'n_clicks'),
     Input('pow', 'n_clicks'),
@@ -972,71 +1083,81 @@ def generate_questionnaire_graph(someinput, quest, agg_val, agg_fig):
     Input('liber', 'n_clicks'),
     Input('hiding', 'n_clicks'),
     Input('filter_store', 'data'),
-    State("map", "figure"),
+    Input('map', 'relayoutData'),
+    Input('map', 'clickData'),
+    State('map_tiles_store', 'data'),
     prevent_initial_call=True
 )
-def make_map(b1, b2, b3, b4, b5, b6, b7, b8, filterdata, relayout):
-    """Update the map."""
-    if filterdata:
-        filterdata = unzip_store(filterdata)
-    if relayout:
-        projection = relayout['layout']['map']['zoom']
-        centering = relayout['layout']['map']['center']
-    else:
-        centering = {'lat': 49, 'lon': 15}
-        projection = 3.7
-
-    fig = go.Figure(go.Choroplethmap(
-        geojson=geojson_data,
-        locations=geojson_df['NAME'],
-        z=[1]*len(geojson_data['features']),
-        featureidkey="properties.NAME",
-        colorscale=[[0, 'rgba(0, 0, 0, 0)'], [1, 'rgba(0, 0, 0, 0)']],
-        hoverinfo='skip',
-        marker={'opacity': .5},
-        marker_line_width=1.5,
-        marker_line_color='black',
-        showscale=False,
-    ))
+def make_map(b1, b2, b3, b4, b5, b6, b7, b8, filterdata, relayout, click, tiles):
+    """Update the point layers of the map.
+
+    Only the changed point traces are sent, as a Patch. The borders (trace 0) and the view stay as they are.
+    The markers are clustered for the zoom level and cover the tile boxes around the views seen so far.
+    Panning out of them adds a box, and only the markers of the new cells are sent and appended.
+    Changing the cluster level, or having too many boxes, redraws the layers for the current view.
+    Clicking a cluster zooms to its places. Plotly sends no relayoutData for that, so the layers and the
+    borders for the new zoom are done here.
+    """
+    triggered = set(ctx.triggered_prop_ids.values())
+    new_boxes = []
+    lod_url = no_update
+    patched_fig = Patch()
+    if 'map' in triggered:
+        triggered.discard('map')
+        if 'map.clickData' in ctx.triggered_prop_ids:
+            if not click or not is_cluster(click):
+                return no_update, no_update, no_update
+            relayout = cluster_relayout(click, tiles['level'])
+            patched_fig['layout']['map']['center'] = relayout['map.center']
+            patched_fig['layout']['map']['zoom'] = relayout['map.zoom']
+            lod_url = borders_url(relayout['map.zoom'])
+            patched_fig['data'][0]['geojson'] = lod_url
+        view = map_view(relayout)
+        if view is not None:
+            level, bounds = view
+            if level != tiles['level'] or len(tiles['boxes']) >= max_tile_boxes:
+                tiles = map_tiles(level, bounds)
+                triggered.add('map')
+            elif not any(box_contains(box, bounds) for box in tiles['boxes']):
+                new_boxes = map_tiles(level, bounds)['boxes']
+        if not triggered and not new_boxes:
+            return no_update, no_update, no_update
+
+    mask = cohort_summary(filterdata).mask if filterdata else None
+
+    clicks = [b1, b2, b3, b4, b5, b6, b7, b8]
+    for slot, ((layer, color), n_clicks) in enumerate(zip(map_layer_buttons, clicks), start=1):
+        active = n_clicks % 2 != 0
+        if layer in triggered or not triggered.isdisjoint({'filter_store', 'map'}):
+            if active:
+                points = marker_points(map_layers[layer], mask, tiles['level'], tiles['boxes'])
+                patched_fig['data'][slot] = generate_trace(points, color)
+            else:
+                patched_fig['data'][slot] = go.Scattermap(lat=[], lon=[], hoverinfo='skip')
+        elif active and new_boxes:
+            points = marker_points(map_layers[layer], mask, tiles['level'], new_boxes, tiles['boxes'])
+            extend_trace(patched_fig['data'][slot], points)
+    tiles = {'level': tiles['level'], 'boxes': tiles['boxes'] + new_boxes}
+    return patched_fig, tiles, lod_url
 
-    fig.update_layout(
-        map_style='carto-voyager-nolabels',
-        map_center=centering,
-        map_zoom=projection,
-        margin=dict(
-            l=0,
-            r=0,
-            t=0,
-            b=0
-        ),
-        showlegend=False,
-    )
 
-    if b1 % 2 != 0:
-        trace = generate_trace(filterdata, birth_df_raw, b1_col, 'KeywordLabel', False)
-        fig.add_trace(trace)
-    if b2 % 2 != 0:
-        trace = generate_trace(filterdata, interncamps_df, b2_col, 'Answer', False)
-        fig.add_trace(trace)
-    if b3 % 2 != 0:
-        trace = generate_trace(filterdata, powcamps_df, b3_col, 'Answer', False)
-        fig.add_trace(trace)
-    if b4 % 2 != 0:
-        trace = generate_trace(filterdata, ghettos_df, b4_col, 'Answer', False)
-        fig.add_trace(trace)
-    if b5 % 2 != 0:
-        trace = generate_trace(filterdata, concamps_df, b5_col, 'Answer', False)
-        fig.add_trace(trace)
-    if b6 % 2 != 0:
-        trace = generate_trace(filterdata, deathcamps_df, b6_col, 'Answer', False)
-        fig.add_trace(trace)
-    if b7 % 2 != 0:
-        trace = generate_trace(filterdata, liberation_df, b7_col, 'Answer', False)
-        fig.add_trace(trace)
-    if b8 % 2 != 0:
-        trace = generate_trace(filterdata, hiding_df, b8_col, 'Answer', False)
-        fig.add_trace(trace)
-    return fig
+@app.callback(
+    Output('map', 'figure', allow_duplicate=True),
+    Output('map_lod_store', 'data'),
+    Input('map', 'relayoutData'),
+    State('map_lod_store', 'data'),
+    prevent_initial_call=True
+)
+def update_map_detail(relayout, current_url):
+    """Swap the borders for the level of detail that fits the new zoom."""
+    if not relayout or 'map.zoom' not in relayout:
+        return no_update, no_update
+    url = borders_url(relayout['map.zoom'])
+    if url == current_url:
+        return no_update, no_update
+    patched_fig = Patch()
+    patched_fig['data'][0]['geojson'] = url
+    return patched_fig, url
 
 
 @app.callback(
@@ -1052,16 +1173,10 @@ def add_location_to_dropdown(click, agg_click, search, opts):
     """Alter the locations dropdown values and options."""
     if ctx.triggered_prop_ids == {'locations_dd.search_value': 'locations_dd'}:
         # print(ctx.triggered_prop_ids)
-        with SQLiteConnection(db_name) as (conn, cursor):
-            query = f"""
-            SELECT DISTINCT KeywordLabel
-            FROM KeywordsTable
-            WHERE Latitude IS NOT NULL AND LOWER(KeywordLabel) LIKE LOWER("%{search}%") LIMIT 10
-            ;"""
-            cursor.execute(query)
-            search = cursor.fetchall()
-        return no_update, [r[0] for r in search] + opts
+        return no_update, [label for label, _ in place_labels.search(search)] + opts
     if ctx.triggered_id == 'map':
+        if is_cluster(click):  # make_map zooms to the cluster instead.
+            return no_update, no_update
         click_text = click["points"][0]["hovertext"]
         return click_text, [click_text]
     elif agg_click['points'][0]['customdata'][1] == 'CityOfBirth':
@@ -1081,21 +1196,17 @@ def add_location_to_dropdown(click, agg_click, search, opts):
 def update_suggestions(search_value, stored_list, pagination):
     """Update the list of people and associated pagination."""
     batch_size = 14
-    if not search_value or search_value == "":
+    if not search_value or not search_value.strip():
         if stored_list:
-            stored_list = unzip_store(stored_list)
+            stored_list = cohort_summary(stored_list).ids
             if pagination is None:
                 pagination = 1
             selected_batch = get_batch(stored_list, batch_size, pagination)
-
-            batch_list = tuple(selected_batch)
-            if len(batch_list) == 0:
-                list_statement = "1=1"
-            elif len(batch_list) == 1:
-                batch_list = f"({batch_list[0]}, {batch_list[0]})"
-            list_statement = f"PIQPersonID IN {batch_list}"
+            list_statement = "PIQPersonID IN (SELECT value FROM json_each(?))"
+            params = (cohort_param(selected_batch),)
         else:
             list_statement = "1=1"
+            params = ()
 
         with SQLiteConnection(db_name) as (conn, cursor):
             query = f"""
@@ -1103,7 +1214,7 @@ def update_suggestions(search_value, stored_list, pagination):
             FROM BioTable
             WHERE {list_statement}
             ;"""
-            cursor.execute(query)
+            cursor.execute(query, params)
             results = cursor.fetchall()
 
         if not results:
@@ -1135,17 +1246,12 @@ def update_suggestions(search_value, stored_list, pagination):
         return text_area, math.ceil((len(stored_list) / batch_size))
 
     if search_value:
-
+        if len(search_value.strip()) < min_search_length:
+            return [f"Type at least {min_search_length} letters of the name."], 1
+        page = 1 if pagination is None else pagination
         with SQLiteConnection(db_name) as (conn, cursor):
-            query = """
-                SELECT FullName, ImageURL, PIQPersonID, ExperienceGroup, DateOfBirth, CountryOfBirth
-                FROM BioTable
-                WHERE FullName LIKE ?
-            """
-            cursor.execute(query, (f'%{search_value}%',))
-            results_pre = cursor.fetchall()
-
-        results = get_batch(results_pre, batch_size, 1 if pagination is None else pagination)
+            total, results = search_names(cursor, search_value, batch_size, batch_size * (page - 1))
+
         text_area = []
         for i in results:
             entry = dbc.Button([
@@ -1172,7 +1278,7 @@ def update_suggestions(search_value, stored_list, pagination):
             text_area.append(entry)
         if text_area == []:
             return ["I am sorry, we were unable to find somebody with that name."], 1
-        return text_area, math.ceil((len(results_pre) / batch_size))
+        return text_area, math.ceil(total / batch_size)
     return ["Click on the map to find people by associated area, or use the search bar for the entire dataset."], 1
 
 
@@ -1227,10 +1333,17 @@ def generate_testimonybuttons(clicked):
     Output('selected_piq_store', 'data'),
     Input({'type': 'tape_button', 'index': ALL, 'intcode': ALL}, "n_clicks"),
     Input({'type': 'personinfo_button', 'intcode': ALL}, "n_clicks"),
+    Input({'type': 'search_tape_button', 'index': ALL, 'intcode': ALL, 'caption': ALL}, "n_clicks"),
     prevent_initial_call=True
 )
-def retrieve_testimony(tape_btn, person_btn):
-    """Fill the testimony area when the associated button is clicked."""
+def retrieve_testimony(tape_btn, person_btn, search_tape_btn):
+    """Fill the testimony area when the associated button is clicked.
+
+    The search_tape_button buttons are in the testimony search results, and open a tape like tape_button,
+    or only the captions around their caption if it isn't 0.
+    """
+    if ctx.triggered_id.get('type') == 'search_tape_button' and not ctx.triggered[0]['value']:
+        return no_update, no_update  # New search results, not a click.
     if ctx.triggered_id.get('type') == 'personinfo_button':
         intcode = int(ctx.triggered_id['intcode'])
         with SQLiteConnection(db_name) as (conn, cursor):
@@ -1322,7 +1435,7 @@ def retrieve_testimony(tape_btn, person_btn):
             geojson_df['subj_id'] = geojson_df['SUBJ'].map(subjecto_mapping)
 
             trace = go.Choroplethmap(
-                geojson=geojson_data,
+                geojson=borders_url(1),
                 locations=geojson_df['NAME'],  # Link to GeoJSON by NAME
                 z=geojson_df['subj_id'],  # Numeric ID for coloring based on SUBJECTO
                 featureidkey="properties.NAME",  # Link GeoJSON properties.NAME to DataFrame
@@ -1477,27 +1590,38 @@ def retrieve_testimony(tape_btn, person_btn):
 
         return combined_info, intcode
 
-    if ctx.triggered_id.get('type') == 'tape_button':
+    if ctx.triggered_id.get('type') in ('tape_button', 'search_tape_button'):
         intcode = int(ctx.triggered_id["intcode"])
         tape_num = int(ctx.triggered_id["index"])
         tape_num += 1
+        caption = ctx.triggered_id.get('caption', 0)
 
         with SQLiteConnection(db_name) as (conn, cursor):
-            query = f"""
-            SELECT TapeTestimony
-            FROM TestimonyTable
-            WHERE IntCode = {intcode} AND TapeNumber = {tape_num};"""
-            cursor.execute(query)
-            testimony = cursor.fetchone()[0]
+            if caption:
+                window = caption_window(cursor, intcode, tape_num, caption)
+                testimony = '\n'.join(
+                    f"`{start[:8]}` " + (f"**{text}**" if number == caption else text)
+                    for number, start, text in window)
+            else:
+                query = f"""
+                SELECT TapeTestimony
+                FROM TestimonyTable
+                WHERE IntCode = {intcode} AND TapeNumber = {tape_num};"""
+                cursor.execute(query)
+                testimony = cursor.fetchone()[0]
             query = f"""
             SELECT FullName, LanguageLabel
             FROM BioTable
             WHERE IntCode = {intcode};"""
             cursor.execute(query)
             biodata = cursor.fetchone()
-        testimony = testimony.replace('?', "?\n")
+        if not caption:
+            testimony = testimony.replace('?', "?\n")
         return dbc.Accordion([
             dbc.AccordionItem([
+                dbc.Button(f"Whole Testimony Part {tape_num}",
+                           id={'type': 'search_tape_button', 'index': tape_num - 1, 'intcode': intcode, 'caption': 0},
+                           n_clicks=0, size='sm', style={'marginBottom': '1vh'}) if caption else None,
                 dcc.Markdown(
                     testimony,
                     id='testimony_text',
@@ -1559,26 +1683,25 @@ def individual_map_button_click_actions(nclick, fig):
 @app.callback(
     Output('wc_area', 'children'),
     Input('accordion', 'children'),
-    State('selected_piq_store', 'data')
+    State('selected_piq_store', 'data'),
+    background=run_in_background,
+    interval=500,
     )
 def generate_wordcloud(trigger, data):
-    """Make the word cloud either for tapes or full texts."""
-    with SQLiteConnection(db_name) as (conn, cursor):
-        if type(data) is int:
-            query = f"""
-            SELECT TapeTestimony
-            FROM TestimonyTable_fts
-            WHERE IntCode = {data} """
-        else:
-            query = f"""
-            SELECT TapeTestimony
-            FROM TestimonyTable
-            WHERE IntCode = {data[0]} AND TapeNumber = {data[1]};"""
-        cursor.execute(query)
-        testimony = cursor.fetchone()[0]
+    """Make the word cloud either for tapes or full texts.
 
-    testimony = kw_model.extract_keywords(docs=testimony, top_n=100, stop_words='english')
-    testimony = [list(tup) for tup in testimony]
+    The keywords are looked up in WordcloudTable (see src/wordcloud_keywords.py), and only
+    extracted here for testimonies that are not in it.
+    """
+    intcode, tape_number = (data, full_interview) if type(data) is int else data
+    testimony = None
+    if wordcloud_engine == 'tfidf' and tfidf_engine.get() is not None:
+        testimony = tfidf_engine.get().keywords(testimony_text(intcode, tape_number))
+    else:
+        with SQLiteConnection(db_name) as (conn, cursor):
+            testimony = lookup_wordcloud(cursor, intcode, tape_number)
+    if testimony is None:
+        testimony = extract_wordcloud(intcode, tape_number)
     testimony = normalise(testimony, vmax=80, vmin=15)
     wordcloud = DashWordcloud(
                     id='wordcloud',
@@ -1597,6 +1720,29 @@ def generate_wordcloud(trigger, data):
     return wordcloud
 
 
+def testimony_text(intcode, tape_number):
+    """Text of a tape, or of the full interview if tape_number is full_interview."""
+    with SQLiteConnection(db_name) as (conn, cursor):
+        if tape_number == full_interview:
+            cursor.execute("""
+            SELECT TapeTestimony
+            FROM TestimonyTable_fts
+            WHERE IntCode = ?;""", (intcode,))
+        else:
+            cursor.execute("""
+            SELECT TapeTestimony
+            FROM TestimonyTable
+            WHERE IntCode = ? AND TapeNumber = ?;""", (intcode, tape_number))
+        return cursor.fetchone()[0]
+
+
+@cache.memoize(timeout=24 * 3600)
+def extract_wordcloud(intcode, tape_number):
+    """Run KeyBERT on a testimony that is missing from WordcloudTable."""
+    return keywords_for_texts(kw_model.get(), [testimony_text(intcode, tape_number)],
+                              [(intcode, tape_number)])[0]
+
+
 @app.callback(
     Output("question_dd", "options"),
     Output("question_dd", "value"),
@@ -1608,19 +1754,10 @@ def generate_questions_options(cohort, selected):
     """Update the questionnaire values and options based on group selected by user."""
     if cohort is None:
         return [], []
-    cohort = unzip_store(cohort)
-    with SQLiteConnection(db_name) as (conn, cursor):
-        query = f"""
-        SELECT DISTINCT QuestionText
-        FROM QuestionsTable
-        WHERE PIQPersonID in {cohort}
-        ;
-        """
-        cursor.execute(query)
-        expgroup_result = cursor.fetchall()
+    expgroup_result = cohort_summary(cohort).questions
     if len(expgroup_result) == 0:
         return [], []
-    expgroup_result_list = [tup[0] for tup in expgroup_result]
+    expgroup_result_list = list(expgroup_result)
     return expgroup_result_list, selected if selected in expgroup_result_list else expgroup_result_list[0]
 
 
@@ -1741,16 +1878,7 @@ def update_button_8(b8):
 def update_answerdd(click, question, exist_values, exist_opts, search):
     """Update answer dropdown."""
     if ctx.triggered_prop_ids == {'answer_dd.search_value': 'answer_dd'}:
-        with SQLiteConnection(db_name) as (conn, cursor):
-            cursor.execute(f"""
-                           SELECT DISTINCT QuestionText, Answer
-                           FROM QuestionsTable
-                           WHERE QuestionText LIKE '%{search}%' COLLATE NOCASE
-                               OR Answer LIKE '%{search}%' COLLATE NOCASE
-                           LIMIT 10;
-                           """)
-            search = cursor.fetchall()
-        return [f'{r[0]}: {r[1]}' for r in search] + exist_opts, no_update
+        return [label for label, _ in answer_labels.search(search)] + exist_opts, no_update
     if click:
         if not exist_values:
             exist_values = []
@@ -1818,10 +1946,15 @@ def update_languagedd(click):
     Output('canvas_button', 'disabled'),
     Input({'type': 'info_button', 'index': ALL}, "n_clicks"),
     Input('canvas_button', 'n_clicks'),
+    Input({'type': 'search_tape_button', 'index': ALL, 'intcode': ALL, 'caption': ALL}, "n_clicks"),
     prevent_initial_call=True
 )
-def toggle_offcanvas(n1, n2):
+def toggle_offcanvas(n1, n2, n3):
     """Open the offcanvas."""
+    if isinstance(ctx.triggered_id, dict) and ctx.triggered_id['type'] == 'search_tape_button':
+        if ctx.triggered[0]['value']:
+            return True, False
+        return no_update, no_update
     if ctx.triggered_id == 'canvas_button':
         return True, False
     elif sum(n1) > 0:
@@ -1839,42 +1972,12 @@ def toggle_offcanvas(n1, n2):
 def update_aggregate_graph(select, someinput):
     """Update the aggregate graph by user criteria."""
     if someinput is not None and select is not None:
-        someinput = unzip_store(someinput)
+        summary = cohort_summary(someinput)
 
         if select == 'DateOfBirth':
-            with SQLiteConnection(db_name) as (conn, cursor):
-                query = f"""
-                    SELECT DateOfBirth, PIQPersonID
-                    FROM BioTable
-                    WHERE PIQPersonID IN {someinput}
-                ;"""
-                cursor.execute(query)
-                dates = cursor.fetchall()
-
-            parsed_dates = []
-            for date_str in dates:
-                try:
-                    string = date_str[0].replace(',', " ")
-                    parsed_date = parser.parse(string)
-                except (ValueError, TypeError, AttributeError):
-                    continue  # Skip unparseable dates
-                parsed_dates.append((parsed_date, date_str[1]))
-            date_df = pd.DataFrame(parsed_dates, columns=['DateOfBirth', 'PIQPersonID'])
-            # date_df['DateOfBirth'] = pd.to_datetime(date_df['DateOfBirth'], errors='coerce')
-
-            date_format = '%b %d, %Y'
-            date_df = date_df[
-                date_df['DateOfBirth'].apply(lambda x: pd.to_datetime(x, format=date_format, errors='coerce')).notna()
-                ]
-
-            cutoff_date = pd.to_datetime('1950-12-31')
-            date_df = date_df[date_df['DateOfBirth'] <= cutoff_date]
-
-            fig = px.histogram(date_df,
-                               x='DateOfBirth',
-                               nbins=min(int(len(date_df['DateOfBirth'])/5), len(range(1892, 1945))),
-                               color_discrete_sequence=[color_scheme_secondary]
-                               )
+            bin_starts, bin_width, counts = summary.birth_histogram
+
+            fig = px.bar(x=bin_starts, y=counts, color_discrete_sequence=[color_scheme_secondary])
             fig.update_layout(
 
                 paper_bgcolor=color_scheme,
@@ -1883,24 +1986,19 @@ def update_aggregate_graph(select, someinput):
                 margin={'l': 0, 'r': 0, 't': 0, 'b': 0},
                 xaxis_title="",
                 yaxis_title="",
+                bargap=0,
                 dragmode='pan'
 
             )
             fig.update_traces(
-                customdata=date_df[[select]].assign(column_name=select),
+                width=bin_width / np.timedelta64(1, 'ms'),  # Date axes measure bar widths in milliseconds.
+                offset=0,
+                customdata=[[str(d), select] for d in bin_starts],
                 hovertemplate='%{x}<br>%{y}<extra></extra>'
             )
             return fig
 
-        with SQLiteConnection(db_name) as (conn, cursor):
-            query = f"""
-                    SELECT {select}, COUNT(*) AS count
-                    FROM BioTable
-                    WHERE PIQPersonID IN {someinput}
-                    GROUP BY {select}
-                    ORDER BY count DESC
-                    ;"""
-            queryfiltered_df = pd.read_sql_query(query, conn)
+        queryfiltered_df = summary.value_counts[select].copy()
         total_sum = queryfiltered_df['count'].sum()
         queryfiltered_df['Percentage'] = (
             queryfiltered_df['count'] / total_sum) * 100
@@ -1950,18 +2048,8 @@ def update_aggregate_graph(select, someinput):
     )
 def generate_data_counter_graph(piq_list):
     """Generate table counting data displayed."""
-    piq_list = unzip_store(piq_list)
-    length = len(piq_list)
-    if length == 2 and piq_list[1] == "":
-        length = 1
-
-    with SQLiteConnection(db_name) as (conn, cursor):
-        query = """
-            SELECT COUNT(DISTINCT PIQPersonID) as count
-            FROM BioTable
-        ;"""
-        cursor.execute(query,)
-        total = cursor.fetchone()[0]
+    length = cohort_summary(piq_list).size
+    total = total_people
     percentage = (length / total) * 100
     percentage = max(percentage, 0.01) if length > 0 else 0.00
     rows = [
@@ -2007,25 +2095,73 @@ def fill_testimony_dd(user_input, click, options, vals):
         return no_update, no_update
 
 
+@app.callback(
+    Output('testimony_search_modal', 'is_open'),
+    Input('testimony_search_button', 'n_clicks'),
+    Input({'type': 'search_tape_button', 'index': ALL, 'intcode': ALL, 'caption': ALL}, "n_clicks"),
+    prevent_initial_call=True
+    )
+def toggle_testimony_search(n_clicks, tape_clicks):
+    """Open the testimony search results, and close them when a tape is opened from them."""
+    if ctx.triggered_id == 'testimony_search_button':
+        return True
+    if ctx.triggered[0]['value']:
+        return False
+    return no_update
+
+
+@app.callback(
+    Output('testimony_search_results', 'children'),
+    Output('testimony_search_pagination', 'max_value'),
+    Output('testimony_search_pagination', 'active_page'),
+    Input('testimony_search_button', 'n_clicks'),
+    Input('testimony_search_pagination', 'active_page'),
+    State('testimony_dd', 'value'),
+    State('filter_store', 'data'),
+    prevent_initial_call=True
+    )
+def update_testimony_search(n_clicks, page, terms, filterdata):
+    """Rank the testimonies of the selection by the search terms (bm25), one page at a time."""
+    if not terms:
+        return "Add search terms with the search bar first.", 1, 1
+    if ctx.triggered_id == 'testimony_search_button' or page is None:
+        page = 1
+    piqs = cohort_summary(filterdata).ids if filterdata else None
+    with SQLiteConnection(db_name) as (conn, cursor):
+        count, results = search_testimonies(cursor, terms, piqs, page)
+    if not results:
+        return "No testimonies of the selection contain all the search terms.", 1, 1
+
+    rows = [html.P(f"{count} testimonies contain {', '.join(terms)}.")]  # Plain text: the terms are user input.
+    for r in results:
+        rows.append(html.Div([
+            dcc.Markdown(f"**{r['FullName']}** (relevance {r['Score']:.1f})"),
+            dcc.Markdown(r['Snippet'], style={'backgroundColor': 'white', 'padding': '1vh', 'whiteSpace': 'pre-line'}),
+            *[html.Div([
+                dbc.Button(f"Part {hit['TapeNumber']}" + (f", {hit['StartTime'][:8]}" if hit['StartTime'] else ''),
+                           id={'type': 'search_tape_button', 'index': hit['TapeNumber'] - 1,
+                               'intcode': r['IntCode'], 'caption': hit['CaptionNumber']},
+                           n_clicks=0, size='sm', style={'marginRight': '.5vw'}),
+                dcc.Markdown(hit['Caption'] or '', style={'display': 'inline-block'}),
+                ], style={'marginTop': '.5vh'}) for hit in r['Hits']],
+            html.Small(f"{r['HitCount'] - len(r['Hits'])} more passages.") if r['HitCount'] > len(r['Hits']) else None,
+            ], style={'marginBottom': '2vh'}))
+    return rows, math.ceil(count / testimony_page_size), page
+
+
+def cohort_keywords(filterdata):
+    """Non-geographic keyword counts of the cohort. Shared by the cloud and the table."""
+    return cohort_summary(filterdata).keywords
+
+
 @app.callback(
     Output('tab1', 'children'),
     Input('filter_store', 'data')
     )
 def update_keywordcloud(filterdata):
     """Update the keyword cloud."""
-    filterdata = unzip_store(filterdata)
-    with SQLiteConnection(db_name) as (conn, cursor):
-        query = f"""
-        SELECT KeywordLabel, COUNT(*) as count
-        FROM KeywordsTable
-        WHERE PIQPersonID IN {filterdata} AND Latitude IS NULL AND KeywordLabel NOT LIKE '%(stills)'
-        GROUP BY KeywordLabel
-        ORDER BY count DESC
-        --LIMIT 1000
-        ;"""
-        cursor.execute(query)
-        keywords = cursor.fetchall()
-    keywords = [[k[0], k[1]] for k in keywords]
+    df = cohort_keywords(filterdata)
+    keywords = [[k, int(c)] for k, c in zip(df['KeywordLabel'], df['count'])]
     keywords = normalise(keywords)
     wordcloud = DashWordcloud(
                     id='keyword_wc',
@@ -2051,18 +2187,7 @@ def update_keywordcloud(filterdata):
     )
 def update_keyword_table(filterdata):
     """Update keyword table."""
-    filterdata = unzip_store(filterdata)
-    with SQLiteConnection(db_name) as (conn, cursor):
-        query = f"""
-        SELECT KeywordLabel, COUNT(*) as count, ParentLabel, RootLabel
-        FROM KeywordsTable
-        WHERE PIQPersonID IN {filterdata} AND Latitude IS NULL AND KeywordLabel NOT LIKE '%(stills)'
-        GROUP BY KeywordLabel
-        ORDER BY count DESC
-        ;
-        """
-        df = pd.read_sql_query(query, conn)
-    return df.to_dict('records')
+    return cohort_keywords(filterdata).to_dict('records')
 
 
 @app.callback(
@@ -2079,13 +2204,7 @@ def update_keyword_table(filterdata):
 def update_keyworddd(click, wc_click, data, ex_val, ex_opt, search):
     """Update the keyword dropdown menu. Dynamically generates options so as to not overload DOM."""
     if ctx.triggered_prop_ids == {'keyword_dd.search_value': 'keyword_dd'}:
-        with SQLiteConnection(db_name) as (conn, cursor):
-            cursor.execute(f"""SELECT KeywordID, KeywordLabel
-                           FROM KeywordsTable WHERE
-                           KeywordLabel LIKE '%{search}%' COLLATE NOCASE LIMIT 10 """)
-            search = cursor.fetchall()
-
-        return no_update, [{'label': r[1], 'value': r[0]} for r in search] + ex_opt
+        return no_update, [{'label': label, 'value': value} for label, value in keyword_labels.search(search)] + ex_opt
     if click and click.get('column_id') in ['count', 'ParentLabel', 'RootLabel', None]:
         return no_update, no_update
     if click or wc_click:
@@ -2127,6 +2246,8 @@ def update_keyworddd(click, wc_click, data, ex_val, ex_opt, search):
 )
 def generate_annotation(click):
     """Create an annotation for the map when an area is clicked on."""
+    if is_cluster(click):  # make_map zooms to the cluster instead.
+        return no_update, no_update, no_update, no_update
     click_text = click["points"][0]["hovertext"]
     annotations = []
 
@@ -2172,6 +2293,8 @@ def clear_searchbar(value):
     return ""
 
 
+print_startup_summary()
+
 if __name__ == "__main__":
     app.run_server(debug=False, use_reloader=False)
     # app.run_server(debug=False, use_reloader=False, threaded=False, host='your ip or something', port=8050)
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+Precompiled map layers.
+
+Each layer (birthplaces, ghettos, camps...) is turned into two aligned arrays
+at startup: the position of the person and the position of the place. Counting
+a cohort's places is then one np.bincount over the cohort mask.
+
+Places are clustered on the server: for every zoom level below
+max_cluster_zoom the places are put in a grid of cells about cluster_pixels
+wide on screen, and the counts of the places in a cell are merged into one
+marker at their weighted centre. Only the cells inside the tile boxes around
+the views seen so far are sent; when the view moves out of them, just the
+cells of the new box that are not on the map yet are added.
+"""
+import math
+import numpy as np
+import pandas as pd
+from src.cohort import person_positions
+
+# Places closer than about this many screen pixels are merged into one marker.
+cluster_pixels = 60
+# From this zoom level on every place gets its own marker.
+max_cluster_zoom = 8
+
+
+def mercator(latitude, longitude):
+    """Web mercator position as fractions of the world width, x to the east and y to the south."""
+    lat = np.radians(np.clip(np.asarray(latitude, dtype=np.float64), -85.05, 85.05))
+    x = (np.asarray(longitude, dtype=np.float64) + 180) / 360
+    y = (1 - np.log(np.tan(lat) + 1 / np.cos(lat)) / np.pi) / 2
+    return x, y
+
+
+def cluster_level(zoom):
+    """Cluster level of a (fractional) map zoom."""
+    return int(min(max(math.floor(zoom), 0), max_cluster_zoom))
+
+
+def grid_size(level):
+    """Number of cluster cells across the world at a level."""
+    return math.ceil(512 * 2 ** level / cluster_pixels)
+
+
+def view_bounds(center, zoom, width=1600, height=900):
+    """Bounds (x0, x1, y0, y1) of a view of width x height pixels, used when the corners are not known."""
+    x, y = mercator(center['lat'], center['lon'])
+    half_w = width / (512 * 2 ** zoom) / 2
+    half_h = height / (512 * 2 ** zoom) / 2
+    return [float(x - half_w), float(x + half_w), float(y - half_h), float(y + half_h)]
+
+
+def corner_bounds(coordinates):
+    """Bounds (x0, x1, y0, y1) of the [lon, lat] corners plotly sends in relayoutData."""
+    lon, lat = np.asarray(coordinates, dtype=np.float64).T
+    x, y = mercator(lat, lon)
+    return [float(x.min()), float(x.max()), float(y.min()), float(y.max())]
+
+
+def tile_box(bounds, level, margin=0.5):
+    """Grow bounds by margin (a fraction of the view) on each side and snap them outwards to the cell grid."""
+    x0, x1, y0, y1 = bounds
+    dx, dy = (x1 - x0) * margin, (y1 - y0) * margin
+    n = grid_size(level)
+    return [max(math.floor((x0 - dx) * n) / n, 0.0), min(math.ceil((x1 + dx) * n) / n, 1.0),
+            max(math.floor((y0 - dy) * n) / n, 0.0), min(math.ceil((y1 + dy) * n) / n, 1.0)]
+
+
+def box_contains(box, bounds):
+    """Whether the view bounds lie inside a tile box (clipped to the world like the box)."""
+    x0, x1, y0, y1 = bounds
+    return (box[0] <= max(x0, 0.0) and min(x1, 1.0) <= box[1]
+            and box[2] <= max(y0, 0.0) and min(y1, 1.0) <= box[3])
+
+
+class MapLayer:
+    """(person, place) pairs of one map layer, plus the table of places.
+
+    The places are sorted by longitude (their mercator x) and the pairs by
+    place, so the places of a box are a contiguous range and so are their
+    pairs. Counting a box only touches the pairs inside its longitude range.
+    """
+
+    def __init__(self, person_idx, place_idx, labels, latitude, longitude):
+        x, y = mercator(latitude, longitude)
+        order = np.argsort(x, kind='stable')
+        rank = np.empty(len(order), dtype=np.int32)
+        rank[order] = np.arange(len(order), dtype=np.int32)
+        place_idx = rank[place_idx]
+        pairs = np.argsort(place_idx, kind='stable')
+
+        self.person_idx = person_idx[pairs]
+        self.place_idx = place_idx[pairs]
+        self.labels = labels[order]
+        self.latitude = latitude[order]
+        self.longitude = longitude[order]
+        self.x, self.y = x[order], y[order]
+        # First pair of every place, plus the end.
+        self.pair_start = np.searchsorted(self.place_idx, np.arange(len(order) + 1))
+        # Cell of every place for each cluster level.
+        self.cells = {}
+        for level in range(max_cluster_zoom):
+            n = grid_size(level)
+            cx = np.minimum((self.x * n).astype(np.int64), n - 1)
+            cy = np.clip((self.y * n).astype(np.int64), 0, n - 1)
+            self.cells[level] = cx * n + cy
+
+    @classmethod
+    def from_frame(cls, df, label_column, person_ids):
+        """Compile a dataframe with PIQPersonID, a place label, Latitude and Longitude."""
+        df = df.dropna(subset=[label_column, 'Latitude', 'Longitude'])
+        places = df[[label_column, 'Latitude', 'Longitude']].drop_duplicates().reset_index(drop=True)
+        place_idx = pd.MultiIndex.from_frame(places).get_indexer(
+            pd.MultiIndex.from_frame(df[[label_column, 'Latitude', 'Longitude']]))
+        person_idx = person_positions(person_ids, df['PIQPersonID'].to_numpy(dtype=np.int64))
+        keep = person_idx >= 0
+        return cls(
+            person_idx[keep].astype(np.int32),
+            place_idx[keep].astype(np.int32),
+            places[label_column].to_numpy(dtype=object),
+            places['Latitude'].to_numpy(dtype=np.float64),
+            places['Longitude'].to_numpy(dtype=np.float64),
+        )
+
+    def place_range(self, box=None):
+        """First and end place of the longitude range of box (x0, x1, y0, y1)."""
+        if box is None:
+            return 0, len(self.labels)
+        first, end = np.searchsorted(self.x, [box[0], box[1]])
+        return int(first), int(end)
+
+    def counts(self, mask=None, box=None):
+        """Number of (person, place) rows per place for the people in mask. None counts everybody.
+
+        With a box only the places in its longitude range are counted, the others are 0.
+        """
+        first, end = self.place_range(box)
+        start, stop = self.pair_start[first], self.pair_start[end]
+        place_idx = self.place_idx[start:stop]
+        if mask is not None:
+            place_idx = place_idx[mask[self.person_idx[start:stop]]]
+        counts = np.zeros(len(self.labels), dtype=np.int64)
+        counts[first:end] = np.bincount(place_idx - first, minlength=end - first)
+        return counts
+
+    def clusters(self, counts, level, box=None, loaded=()):
+        """Merge the places with a count into the cells of a cluster level.
+
+        Only places inside box (x0, x1, y0, y1) and outside the loaded boxes
+        are used. Returns, per cluster, the weighted centre, the summed count,
+        the biggest place, the number of places in it and the west, south,
+        east and north bounds of its places.
+        """
+        first, end = self.place_range(box)
+        places = first + np.flatnonzero(counts[first:end])
+        x, y = self.x[places], self.y[places]
+        if box is not None:
+            inside = (y >= box[2]) & (y < box[3])
+            for x0, x1, y0, y1 in loaded:
+                inside &= ~((x >= x0) & (x < x1) & (y >= y0) & (y < y1))
+            places = places[inside]
+        weights = counts[places].astype(np.float64)
+        if level >= max_cluster_zoom:
+            cluster = np.arange(len(places))
+        else:
+            cluster = np.unique(self.cells[level][places], return_inverse=True)[1].ravel()
+        n = int(cluster.max()) + 1 if len(places) else 0
+
+        total = np.bincount(cluster, weights=weights, minlength=n)
+        latitude = np.bincount(cluster, weights=weights * self.latitude[places], minlength=n) / np.maximum(total, 1)
+        longitude = np.bincount(cluster, weights=weights * self.longitude[places], minlength=n) / np.maximum(total, 1)
+        size = np.bincount(cluster, minlength=n)
+        order = np.lexsort((-weights, cluster))  # Biggest place first within each cluster.
+        starts = np.r_[0, np.flatnonzero(np.diff(cluster[order])) + 1] if n else order
+        lat, lon = self.latitude[places[order]], self.longitude[places[order]]
+        bounds = [reduce.reduceat(values, starts) if n else values
+                  for reduce, values in ((np.minimum, lon), (np.minimum, lat), (np.maximum, lon), (np.maximum, lat))]
+        return (latitude, longitude, total.astype(np.int64), places[order[starts]], size, *bounds)
@@ -0,0 +1,357 @@
+# -*- coding: utf-8 -*-
+"""
+Survivor name search for the search bar.
+
+A LIKE '%name%' over BioTable can't use idx_name, so every keystroke scanned
+the whole table. NameTable_fts is an FTS5 index of FullName and Aliases with
+the trigram tokenizer, so any substring of 3 or more characters is found
+from the index; shorter searches find nothing, as they would match most
+names. Its rowid is the PIQPersonID. Matches are ranked exact name
+first, then names starting with the search, then names with a word starting
+with it, then the rest. Only the page that is shown is read from BioTable.
+
+The same names are spelled many ways (Schwarz, Szwarc, Shvarts), so after
+the substring matches come the people with a name word that sounds the same
+or is spelled almost the same as each word searched:
+
+- NameWordTable: the words of each person's name and aliases, in capitals
+  without accents.
+- NameKeyTable: the Daitch-Mokotoff codes of each word. A word can have
+  several, as some letters (C, CH, J, RZ) can sound two ways.
+- NameDeleteTable: each word with one letter left out. Two words with a
+  variant in common are at most two edits apart, the exact distance is then
+  checked against max_distance.
+
+Run from the project root, with write access to the database:
+
+    python -m src.name_search [databases/nov18.db]
+
+Databases made before NameTable_fts fall back to LIKE over BioTable, and
+without the word tables there are no sound-alike matches.
+"""
+import json
+import re
+import sqlite3
+import sys
+import time
+import unicodedata
+
+name_table = 'NameTable_fts'
+
+# Score of a matched word, lower is better: the edit distance, or phonetic_score if it only sounds the same.
+phonetic_score = 1.5
+min_search_length = 3  # Length of a trigram. Shorter searches return nothing.
+min_fuzzy_length = 3  # Shorter words are only searched as substrings.
+
+# Letters without an accent-free decomposition in NFKD.
+_letters = str.maketrans({'ß': 'SS', 'Ł': 'L', 'ł': 'L', 'Ø': 'O', 'ø': 'O', 'Đ': 'D', 'đ': 'D',
+                          'Æ': 'AE', 'æ': 'AE', 'Œ': 'OE', 'œ': 'OE'})
+
+# Daitch-Mokotoff rules: codes of a letter group at the start of a word, before a vowel, and elsewhere.
+# '' is not coded, '|' separates the alternatives of groups that can sound two ways.
+_dm_vowels = set('AEIOU')
+_dm_rules = {}
+for _patterns, _codes in [
+    ('AI AJ AY', ('0', '1', '')), ('AU', ('0', '7', '')), ('A', ('0', '', '')),
+    ('B', ('7', '7', '7')),
+    ('CHS', ('5', '54', '54')), ('CH', ('5|4', '5|4', '5|4')), ('CK', ('5|45', '5|45', '5|45')),
+    ('CZ CS CSZ CZS', ('4', '4', '4')), ('C', ('5|4', '5|4', '5|4')),
+    ('DRZ DRS DS DSH DSZ DZ DZH DZS', ('4', '4', '4')), ('D DT', ('3', '3', '3')),
+    ('EI EJ EY', ('0', '1', '')), ('EU', ('1', '1', '')), ('E', ('0', '', '')),
+    ('FB F', ('7', '7', '7')),
+    ('G', ('5', '5', '5')),
+    ('H', ('5', '5', '')),
+    ('IA IE IO IU', ('1', '', '')), ('I', ('0', '', '')),
+    ('J', ('1|4', '|4', '|4')),
+    ('KS', ('5', '54', '54')), ('KH K', ('5', '5', '5')),
+    ('L', ('8', '8', '8')),
+    ('MN NM', ('66', '66', '66')), ('M N', ('6', '6', '6')),
+    ('OI OJ OY', ('0', '1', '')), ('O', ('0', '', '')),
+    ('P PF PH', ('7', '7', '7')),
+    ('Q', ('5', '5', '5')),
+    ('RZ RS', ('94|4', '94|4', '94|4')), ('R', ('9', '9', '9')),
+    ('SCHTSCH SCHTSH SCHTCH SHTCH SHCH SHTSH STCH STSCH SC STRZ STRS STSH SZCZ SZCS', ('2', '4', '4')),
+    ('SHT SCHT SCHD ST SZT SHD SZD SD', ('2', '43', '43')),
+    ('SCH SH SZ S', ('4', '4', '4')),
+    ('TCH TTCH TTSCH TRZ TRS TSCH TSH TS TTS TTSZ TC TZ TTZ TZS TSZ', ('4', '4', '4')),
+    ('TH T', ('3', '3', '3')),
+    ('UI UJ UY', ('0', '1', '')), ('U UE', ('0', '', '')),
+    ('V W', ('7', '7', '7')),
+    ('X', ('5', '54', '54')),
+    ('Y', ('1', '', '')),
+    ('ZDZ ZDZH ZHDZH', ('2', '4', '4')), ('ZD ZHD', ('2', '43', '43')),
+    ('ZH ZS ZSCH ZSH Z', ('4', '4', '4')),
+]:
+    for _pattern in _patterns.split():
+        _dm_rules[_pattern] = _codes
+_dm_longest = max(len(p) for p in _dm_rules)
+
+
+def name_words(text):
+    """Words of a name in capitals without accents, e.g. 'Łódź-Müller' -> ['LODZ', 'MULLER']."""
+    text = unicodedata.normalize('NFKD', text.translate(_letters))
+    text = ''.join(c for c in text if not unicodedata.combining(c)).upper()
+    return [word for word in re.findall('[A-Z]+', text) if len(word) >= 2]
+
+
+def dm_soundex(word):
+    """Daitch-Mokotoff codes of a word from name_words, as a set of 6 digit strings."""
+    branches = {('', None)}  # (code so far, code of the last letter group)
+    i = 0
+    while i < len(word):
+        for length in range(min(_dm_longest, len(word) - i), 0, -1):
+            pattern = word[i:i + length]
+            if pattern in _dm_rules:
+                break
+        start, before_vowel, other = _dm_rules[pattern]
+        if i == 0:
+            codes = start
+        elif word[i + length:i + length + 1] in _dm_vowels:
+            codes = before_vowel
+        else:
+            codes = other
+        # Letter groups next to each other with the same code are coded once, except MN and NM.
+        branches = {(code if last is not None and last.endswith(alt) and pattern not in ('MN', 'NM')
+                     else code + alt, alt)
+                    for code, last in branches for alt in codes.split('|')}
+        i += length
+    return {(code + '000000')[:6] for code, _ in branches}
+
+
+def deletions(word):
+    """The word, and the word with each of its letters left out."""
+    return {word} | {word[:i] + word[i + 1:] for i in range(len(word))}
+
+
+def max_distance(word):
+    """Edit distance allowed for a word: 1 for short words, 2 for longer ones."""
+    return 1 if len(word) <= 5 else 2
+
+
+def edit_distance(a, b, bound):
+    """Levenshtein distance of a and b, or bound + 1 if it is more than bound."""
+    if abs(len(a) - len(b)) > bound:
+        return bound + 1
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, start=1):
+        current = [i]
+        for j, cb in enumerate(b, start=1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        if min(current) > bound:
+            return bound + 1
+        previous = current
+    return min(previous[-1], bound + 1)
+
+
+def make_name_index(dbname):
+    """Create NameTable_fts and the word tables from the names and aliases in BioTable."""
+    conn = sqlite3.connect(dbname, timeout=10)
+    cursor = conn.cursor()
+    start = time.time()
+    cursor.execute(f"DROP TABLE IF EXISTS {name_table};")
+    cursor.execute(f'''
+    CREATE VIRTUAL TABLE {name_table}
+    USING fts5(
+        FullName,
+        Aliases,
+        tokenize="trigram"
+    );
+    ''')
+    # Aliases were stored with str(), so people without aliases have 'None'.
+    cursor.execute(f'''
+    INSERT INTO {name_table} (rowid, FullName, Aliases)
+    SELECT PIQPersonID, FullName, NULLIF(Aliases, 'None')
+    FROM BioTable
+    WHERE FullName IS NOT NULL
+    ''')
+    cursor.execute(f"INSERT INTO {name_table}({name_table}) VALUES('optimize');")
+
+    person_words = set()
+    for piq, full_name, aliases in cursor.execute(f"SELECT rowid, FullName, Aliases FROM {name_table};").fetchall():
+        for word in name_words(f'{full_name} {aliases or ""}'):
+            person_words.add((word, piq))
+    words = {word for word, _ in person_words}
+
+    cursor.execute("DROP TABLE IF EXISTS NameWordTable;")
+    cursor.execute("DROP TABLE IF EXISTS NameKeyTable;")
+    cursor.execute("DROP TABLE IF EXISTS NameDeleteTable;")
+    cursor.execute('''
+    CREATE TABLE NameWordTable (
+        Word TEXT,
+        PIQPersonID INTEGER,
+        PRIMARY KEY (Word, PIQPersonID)
+    ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+    CREATE TABLE NameKeyTable (
+        Key TEXT,
+        Word TEXT,
+        PRIMARY KEY (Key, Word)
+    ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+    CREATE TABLE NameDeleteTable (
+        Variant TEXT,
+        Word TEXT,
+        PRIMARY KEY (Variant, Word)
+    ) WITHOUT ROWID
+    ''')
+    cursor.executemany("INSERT INTO NameWordTable (Word, PIQPersonID) VALUES (?, ?)", sorted(person_words))
+    cursor.executemany("INSERT INTO NameKeyTable (Key, Word) VALUES (?, ?)",
+                       sorted({(key, word) for word in words for key in dm_soundex(word)}))
+    cursor.executemany("INSERT INTO NameDeleteTable (Variant, Word) VALUES (?, ?)",
+                       sorted({(variant, word) for word in words for variant in deletions(word)}))
+    conn.commit()
+    count = cursor.execute(f"SELECT COUNT(*) FROM {name_table};").fetchone()[0]
+    print(f"{count} names with {len(words)} different words indexed in {time.time() - start:.1f} seconds")
+    cursor.execute("PRAGMA optimize;")
+    cursor.close()
+    conn.close()
+
+
+def similar_words(cursor, word):
+    """Name words that sound the same as word or are within max_distance edits of it, with their scores."""
+    matches = {}
+    cursor.execute("""
+        SELECT Word
+        FROM NameKeyTable
+        WHERE Key IN (SELECT value FROM json_each(?))
+        ;""", (json.dumps(sorted(dm_soundex(word))),))
+    for (match,) in cursor.fetchall():
+        matches[match] = phonetic_score
+    cursor.execute("""
+        SELECT DISTINCT Word
+        FROM NameDeleteTable
+        WHERE Variant IN (SELECT value FROM json_each(?))
+        ;""", (json.dumps(sorted(deletions(word))),))
+    bound = max_distance(word)
+    for (match,) in cursor.fetchall():
+        distance = edit_distance(word, match, bound)
+        if distance <= bound:
+            matches[match] = min(matches.get(match, distance), distance)
+    return matches
+
+
+def fuzzy_names(cursor, text):
+    """PIQPersonIDs of the people with a name word like each word of text, best first.
+
+    A person's score is the sum of the best score of each word searched. Returns [] if the
+    database has no word tables.
+    """
+    words = [word for word in name_words(text) if len(word) >= min_fuzzy_length]
+    if not words:
+        return []
+    scores = None
+    try:
+        for word in words:
+            matches = similar_words(cursor, word)
+            cursor.execute("""
+                SELECT Word, PIQPersonID
+                FROM NameWordTable
+                WHERE Word IN (SELECT value FROM json_each(?))
+                ;""", (json.dumps(list(matches)),))
+            word_scores = {}
+            for match, piq in cursor.fetchall():
+                word_scores[piq] = min(word_scores.get(piq, matches[match]), matches[match])
+            if scores is None:
+                scores = word_scores
+            else:
+                scores = {piq: score + word_scores[piq] for piq, score in scores.items() if piq in word_scores}
+            if not scores:
+                return []
+    except sqlite3.OperationalError:  # Database made before the word tables.
+        return []
+    cursor.execute("""
+        SELECT PIQPersonID, FullName
+        FROM BioTable
+        WHERE PIQPersonID IN (SELECT value FROM json_each(?))
+        ;""", (json.dumps(list(scores)),))
+    names = dict(cursor.fetchall())
+    return sorted(scores, key=lambda piq: (scores[piq], names.get(piq) or '', piq))
+
+
+def _like_pattern(text):
+    """text for a LIKE ... ESCAPE '\\' pattern, with its wildcards escaped."""
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _substring_search(cursor, text):
+    """Table, PIQPersonID column and condition of the substring search. BioTable if there is no NameTable_fts."""
+    try:
+        cursor.execute(f"SELECT 1 FROM {name_table} LIMIT 1;")
+    except sqlite3.OperationalError:  # Database made before NameTable_fts.
+        return "BioTable N", "N.PIQPersonID", "N.FullName LIKE '%' || :text || '%' ESCAPE '\\'"
+    # A phrase query finds the rows containing all the trigrams of text, in order.
+    return f"{name_table} N", "N.rowid", f"{name_table} MATCH :match"
+
+
+# Exact name first, then names starting with the search, then a word of the name starting with it.
+_rank = """
+    CASE
+        WHEN N.FullName LIKE :text ESCAPE '\\' THEN 0
+        WHEN N.FullName LIKE :text || '%' ESCAPE '\\' THEN 1
+        WHEN N.FullName LIKE '% ' || :text || '%' ESCAPE '\\' THEN 2
+        ELSE 3
+    END"""
+
+
+def search_names(cursor, text, limit, offset=0):
+    """One page of the people whose name or alias contains text, then of those with a name like it.
+
+    Returns the number of matches and the page of rows (FullName, ImageURL, PIQPersonID,
+    ExperienceGroup, DateOfBirth, CountryOfBirth). Nothing for searches shorter than min_search_length.
+    """
+    text = text.strip()
+    if len(text) < min_search_length:
+        return 0, []
+    source, piq, where = _substring_search(cursor, text)
+    params = {'text': _like_pattern(text), 'match': '"' + text.replace('"', '""') + '"',
+              'limit': limit, 'offset': offset}
+    cursor.execute(f"""
+        SELECT COUNT(*)
+        FROM {source}
+        WHERE {where}
+        ;""", params)
+    count = cursor.fetchone()[0]
+
+    # Sound-alike and misspelt names that are not substring matches already.
+    fuzzy = fuzzy_names(cursor, text)
+    if fuzzy:
+        cursor.execute(f"""
+            SELECT {piq}
+            FROM {source}
+            WHERE {where} AND {piq} IN (SELECT value FROM json_each(:ids))
+            ;""", {**params, 'ids': json.dumps(fuzzy)})
+        found = {r[0] for r in cursor.fetchall()}
+        fuzzy = [p for p in fuzzy if p not in found]
+
+    rows = []
+    if offset < count:
+        cursor.execute(f"""
+            SELECT B.FullName, B.ImageURL, B.PIQPersonID, B.ExperienceGroup, B.DateOfBirth, B.CountryOfBirth
+            FROM (
+                SELECT {piq} AS PIQPersonID, {_rank} AS rank, N.FullName
+                FROM {source}
+                WHERE {where}
+                ORDER BY rank, N.FullName
+                LIMIT :limit OFFSET :offset
+            ) AS page
+            JOIN BioTable B ON B.PIQPersonID = page.PIQPersonID
+            ORDER BY page.rank, page.FullName
+            ;""", params)
+        rows = cursor.fetchall()
+    fuzzy_start = max(0, offset - count)
+    page = fuzzy[fuzzy_start:fuzzy_start + limit - len(rows)]
+    if page:
+        cursor.execute("""
+            SELECT FullName, ImageURL, PIQPersonID, ExperienceGroup, DateOfBirth, CountryOfBirth
+            FROM BioTable
+            WHERE PIQPersonID IN (SELECT value FROM json_each(?))
+            ;""", (json.dumps(page),))
+        by_piq = {r[2]: r for r in cursor.fetchall()}
+        rows += [by_piq[p] for p in page if p in by_piq]
+    return count + len(fuzzy), rows
+
+
+if __name__ == "__main__":
+    make_name_index(sys.argv[1] if len(sys.argv) > 1 else 'databases/nov18.db')
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+Offline simplification of the historical borders (maps/map.geojson).
+
+Writes maps/map_lod1.geojson, maps/map_lod2.geojson... with fewer vertices for
+lower zoom levels. Run from the project root:
+
+    python -m src.simplify_geojson
+
+Borders shared by two territories are simplified once, so neighbours still
+line up: rings are cut into arcs at the junctions (points where the borders of
+different territories meet or split), every arc is simplified with
+Douglas-Peucker keeping its end points, and the rings are put back together.
+A territory all of whose rings collapse is kept as a small diamond through the
+extreme points of its biggest ring, so it stays on the map.
+
+The source is already coarse (about 35.6k vertices for the world), so keeping
+the error within one pixel only halves it at the default zoom of 3.7. The app
+allows up to lod_pixels pixels of error instead. Below zoom 4 that is level 3
+(about 8.9k vertices, 167KB instead of 1.3MB, at the default zoom) or level 4
+for world views (5.4k vertices, 116KB). Borders are drawn about a pixel wide,
+and moving them by a few pixels at continental zooms isn't visible.
+"""
+import json
+import math
+import os
+
+source_path = 'maps/map.geojson'
+
+# Tolerance in degrees per level. A pixel is 360 / (512 * 2**zoom) degrees wide,
+# so about 0.05 degrees at the default zoom of 3.7 and 0.01 at zoom 6.
+lod_tolerances = {
+    1: 0.01,
+    2: 0.05,
+    3: 0.15,
+    4: 0.3,
+}
+# Largest simplification error allowed on screen, in pixels.
+lod_pixels = 3
+
+
+def lod_path(level):
+    """File name of a level of detail. Level 0 is the original file."""
+    if level == 0:
+        return source_path
+    return f'maps/map_lod{level}.geojson'
+
+
+def lod_for_zoom(zoom, levels, pixels=lod_pixels):
+    """Coarsest of the available levels whose tolerance is below the given number of pixels at this zoom."""
+    pixel = 360 / (512 * 2 ** zoom)
+    best = 0
+    for level, tolerance in levels.items():
+        if tolerance <= pixels * pixel and tolerance > levels.get(best, 0):
+            best = level
+    return best
+
+
+def _polygons(geometry):
+    """List of polygons (lists of rings) of a Polygon or MultiPolygon."""
+    if geometry['type'] == 'Polygon':
+        return [geometry['coordinates']]
+    return geometry['coordinates']
+
+
+def _open_ring(ring):
+    """Ring as a list of point tuples without the closing point."""
+    points = [tuple(p[:2]) for p in ring]
+    if len(points) > 1 and points[0] == points[-1]:
+        points = points[:-1]
+    return points
+
+
+def find_junctions(rings):
+    """Points where rings meet or split, found by comparing the neighbours of every occurrence."""
+    neighbours = {}
+    junctions = set()
+    for ring in rings:
+        n = len(ring)
+        for i, point in enumerate(ring):
+            pair = frozenset((ring[i - 1], ring[(i + 1) % n]))
+            seen = neighbours.setdefault(point, pair)
+            if seen != pair:
+                junctions.add(point)
+    return junctions
+
+
+def _segment_distance(p, a, b):
+    """Distance from point p to the segment a-b."""
+    dx, dy = b[0] - a[0], b[1] - a[1]
+    if dx == 0 and dy == 0:
+        return ((p[0] - a[0]) ** 2 + (p[1] - a[1]) ** 2) ** 0.5
+    t = ((p[0] - a[0]) * dx + (p[1] - a[1]) * dy) / (dx * dx + dy * dy)
+    t = max(0.0, min(1.0, t))
+    x, y = a[0] + t * dx, a[1] + t * dy
+    return ((p[0] - x) ** 2 + (p[1] - y) ** 2) ** 0.5
+
+
+def douglas_peucker(points, tolerance):
+    """Simplify an open line, keeping both end points."""
+    if len(points) < 3:
+        return list(points)
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        max_dist, index = 0.0, None
+        for i in range(first + 1, last):
+            dist = _segment_distance(points[i], points[first], points[last])
+            if dist > max_dist:
+                max_dist, index = dist, i
+        if index is not None and max_dist > tolerance:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return [p for p, k in zip(points, keep) if k]
+
+
+class ArcSimplifier:
+    """Simplifies arcs once, whichever direction they are walked in."""
+
+    def __init__(self, tolerance):
+        self.tolerance = tolerance
+        self._done = {}
+
+    def arc(self, points):
+        """Simplified open arc with fixed end points."""
+        forward = tuple(points)
+        backward = forward[::-1]
+        key = min(forward, backward)
+        if key not in self._done:
+            self._done[key] = douglas_peucker(key, self.tolerance)
+        return self._done[key] if key == forward else self._done[key][::-1]
+
+    def closed(self, points):
+        """Simplified ring with no junctions, split at the point farthest from its start."""
+        start = points.index(min(points))
+        points = points[start:] + points[:start]
+        far = max(range(len(points)), key=lambda i: _segment_distance(points[i], points[0], points[0]))
+        first = self.arc(points[:far + 1])
+        second = self.arc(points[far:] + points[:1])
+        return first[:-1] + second[:-1]
+
+
+def simplify_ring(ring, junctions, simplifier, digits):
+    """Simplify one ring (without closing point). Returns a closed ring, or None if it collapsed."""
+    cuts = [i for i, p in enumerate(ring) if p in junctions]
+    if not cuts:
+        points = simplifier.closed(ring)
+    else:
+        ring = ring[cuts[0]:] + ring[:cuts[0]]
+        cuts = [i - cuts[0] for i in cuts] + [len(ring)]
+        ring = ring + ring[:1]
+        points = []
+        for start, end in zip(cuts[:-1], cuts[1:]):
+            points.extend(simplifier.arc(ring[start:end + 1])[:-1])
+    if len(points) < 3:
+        return None
+    return [[round(x, digits), round(y, digits)] for x, y in points + points[:1]]
+
+
+def diamond(geometry, digits):
+    """Polygon through the westmost, southmost, eastmost and northmost points of the biggest outer ring."""
+    def extent(ring):
+        return (max(x for x, _ in ring) - min(x for x, _ in ring)) * (max(y for _, y in ring) - min(y for _, y in ring))
+    ring = max((_open_ring(polygon[0]) for polygon in _polygons(geometry)), key=extent)
+    corners = sorted({min(range(len(ring)), key=lambda i: (ring[i][0], ring[i][1])),
+                      min(range(len(ring)), key=lambda i: (ring[i][1], ring[i][0])),
+                      max(range(len(ring)), key=lambda i: (ring[i][0], ring[i][1])),
+                      max(range(len(ring)), key=lambda i: (ring[i][1], ring[i][0]))})
+    if len(corners) < 3:
+        return geometry
+    points = [[round(ring[i][0], digits), round(ring[i][1], digits)] for i in corners]
+    return {'type': 'Polygon', 'coordinates': [points + points[:1]]}
+
+
+def simplify_geojson(geojson, tolerance):
+    """Topology preserving simplification of a FeatureCollection of (Multi)Polygons."""
+    rings = [_open_ring(ring)
+             for feature in geojson['features']
+             for polygon in _polygons(feature['geometry'])
+             for ring in polygon]
+    junctions = find_junctions(rings)
+    simplifier = ArcSimplifier(tolerance)
+    digits = math.ceil(-math.log10(tolerance / 10))  # Rounding well below the tolerance.
+
+    features = []
+    for feature in geojson['features']:
+        polygons = []
+        for polygon in _polygons(feature['geometry']):
+            outer = simplify_ring(_open_ring(polygon[0]), junctions, simplifier, digits)
+            if outer is None:
+                continue
+            holes = [simplify_ring(_open_ring(ring), junctions, simplifier, digits) for ring in polygon[1:]]
+            polygons.append([outer] + [h for h in holes if h is not None])
+        geometry = {'type': 'MultiPolygon', 'coordinates': polygons}
+        if not polygons:  # Keep tiny territories as a diamond, rather than dropping them.
+            geometry = diamond(feature['geometry'], digits)
+        features.append({'type': 'Feature', 'properties': feature['properties'], 'geometry': geometry})
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+def count_points(geojson):
+    """Number of vertices in a FeatureCollection."""
+    return sum(len(ring)
+               for feature in geojson['features']
+               for polygon in _polygons(feature['geometry'])
+               for ring in polygon)
+
+
+if __name__ == "__main__":
+    with open(source_path, mode='r', encoding='utf-8') as f:
+        source = json.load(f)
+    print(f'{source_path}: {count_points(source)} points, {os.path.getsize(source_path)} bytes')
+    for level, tol in lod_tolerances.items():
+        simplified = simplify_geojson(source, tol)
+        with open(lod_path(level), mode='w', encoding='utf-8') as f:
+            json.dump(simplified, f, separators=(',', ':'))
+        print(f'{lod_path(level)}: {count_points(simplified)} points, {os.path.getsize(lod_path(level))} bytes')
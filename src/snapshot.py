@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Snapshot of the startup dataframes (load_startup_frames) in Arrow IPC files.
+
+Build it after every change to the database, from the project root:
+
+    python -m src.snapshot [databases/nov18.db]
+
+The snapshot is written to snapshots/<fingerprint>/, one <name>.arrow file per
+dataframe. Workers memory-map the files at startup instead of running the
+startup queries. Numeric columns without missing values are used straight from
+the mapped file. If the database changed since the snapshot was built, or
+pyarrow is not installed (pip install pyarrow), the app falls back to the SQL
+queries.
+"""
+import errno
+import hashlib
+import os
+import shutil
+import sys
+import time
+from src.startup import load_startup_frames, startup_frame_names
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+snapshot_dir = 'snapshots'
+# Bump when load_startup_frames changes, so old snapshots are not used any more.
+snapshot_version = 1
+
+
+def db_fingerprint(db_name):
+    """Hash identifying the database file.
+
+    Uses the size, modification time and the 100 byte SQLite header, which
+    holds the file change counter. Hashing the whole file would take longer
+    than running the queries.
+    """
+    stat = os.stat(db_name)
+    with open(db_name, 'rb') as f:
+        header = f.read(100)
+    digest = hashlib.sha1(f'{snapshot_version}:{stat.st_size}:{stat.st_mtime_ns}:'.encode('utf-8') + header)
+    return digest.hexdigest()[:16]
+
+
+def snapshot_path(db_name):
+    """Directory of the snapshot for the current state of the database."""
+    return os.path.join(snapshot_dir, db_fingerprint(db_name))
+
+
+def missing_frames(path):
+    """Names of the startup dataframes that have no file in a snapshot directory."""
+    return [name for name in startup_frame_names if not os.path.isfile(os.path.join(path, f'{name}.arrow'))]
+
+
+def write_snapshot(db_name, frames):
+    """Write the dataframes to the snapshot of the database. Returns its directory.
+
+    The files are written to a temporary directory that is then renamed, so a snapshot is never seen half
+    written. If a complete snapshot is there already (an earlier run, or another worker at the same time),
+    it is kept. An incomplete one is replaced.
+    """
+    path = snapshot_path(db_name)
+    temporary = f'{path}.{os.getpid()}.tmp'
+    os.makedirs(temporary, exist_ok=True)
+    for name, df in frames.items():
+        table = pa.Table.from_pandas(df.reset_index(drop=True), preserve_index=False)
+        with pa.OSFile(os.path.join(temporary, f'{name}.arrow'), 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+    try:
+        os.replace(temporary, path)
+    except OSError as e:
+        if e.errno not in (errno.ENOTEMPTY, errno.EEXIST):
+            raise
+        if missing_frames(path):
+            old = f'{path}.{os.getpid()}.old'
+            os.replace(path, old)
+            os.replace(temporary, path)
+            shutil.rmtree(old, ignore_errors=True)
+        else:
+            shutil.rmtree(temporary, ignore_errors=True)
+    return path
+
+
+def read_snapshot(db_name):
+    """Read the dataframes of the database's snapshot. Returns None if there is no complete, up to date snapshot."""
+    if pa is None:
+        return None
+    path = snapshot_path(db_name)
+    if not os.path.isdir(path):
+        print(f'No snapshot of {db_name} in {snapshot_dir}, running the startup queries')
+        return None
+    missing = missing_frames(path)
+    if missing:
+        print(f'Snapshot {path} has no {", ".join(missing)}, running the startup queries')
+        return None
+    frames = {}
+    for name in startup_frame_names:
+        try:
+            source = pa.memory_map(os.path.join(path, f'{name}.arrow'), 'r')
+            table = pa.ipc.open_file(source).read_all()
+        except (OSError, pa.ArrowInvalid) as e:
+            print(f'Could not read {name} from snapshot {path} ({e}), running the startup queries')
+            return None
+        frames[name] = table.to_pandas(split_blocks=True)
+    return frames
+
+
+if __name__ == "__main__":
+    if pa is None:
+        sys.exit('The snapshot needs pyarrow')
+    db_name = sys.argv[1] if len(sys.argv) > 1 else 'databases/nov18.db'
+    start = time.time()
+    frames = load_startup_frames(db_name)
+    print(f'Startup queries took {time.time() - start:.2f} seconds')
+    print(f'Snapshot written to {write_snapshot(db_name, frames)}')
@@ -11,6 +11,7 @@ Created on Sun Sep 29 00:57:36 2024.
 # =============================================================================
 
 import os
+import re
 import json
 import sqlite3
 import webvtt
@@ -29,6 +30,17 @@ def convert_date(date):
         return None
 
 
+def birth_year(date_text, dobint=None):
+    """Get the year of birth from DOBINT, or from a four digit year in the date text."""
+    if dobint:
+        return dobint // 10000
+    if date_text:
+        match = re.search(r'\b(1[89]\d\d|20\d\d)\b', date_text)
+        if match:
+            return int(match.group(1))
+    return None
+
+
 print(convert_date('Oct 1, 1995'))
 
 # %% Defining functions for loading database.
@@ -55,6 +67,7 @@ def make_bio_table(dbname, folder_path, batch_size=2000):
         CountryOfBirth TEXT,
         DateOfBirth TEXT,
         DOBINT INTEGER,
+        BirthYear INTEGER,
         ExperienceGroup TEXT,
         ImageURL TEXT,
         LanguageLabel TEXT,
@@ -84,6 +97,7 @@ def make_bio_table(dbname, folder_path, batch_size=2000):
                     testimony_data = data["Testimony"]
                     bio = data["Bio"]
                     # Prepare a row of data
+                    dobint = convert_date(bio.get('DateOfBirthText'))
                     bio_row = (
                         bio["PIQPersonID"],
                         bio.get("FullName"),
@@ -91,7 +105,8 @@ def make_bio_table(dbname, folder_path, batch_size=2000):
                         bio.get("CityOfBirth"),
                         bio.get("CountryOfBirth"),
                         bio.get('DateOfBirthText'),
-                        convert_date(bio.get('DateOfBirthText')),
+                        dobint,
+                        birth_year(bio.get('DateOfBirthText'), dobint),
                         bio.get("ExperienceGroup"),
                         bio.get("ImageURL"),
                         testimony_data.get("LanguageLabel"),
@@ -112,13 +127,13 @@ def make_bio_table(dbname, folder_path, batch_size=2000):
                         cursor.executemany('''
                         INSERT OR REPLACE INTO BioTable (PIQPersonID, FullName, Gender,
                                                          CityOfBirth, CountryOfBirth,
-                                                         DateOfBirth, DOBINT, ExperienceGroup,
+                                                         DateOfBirth, DOBINT, BirthYear, ExperienceGroup,
                                                          ImageURL, LanguageLabel, IntCode,
                                                          InterviewDate, Aliases,
                                                          InterviewLength, InVHAOnline,
                                                          Interviewers, InterviewLocation,
                                                          OrganizationName)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
                         ''', batch_data)
                         conn.commit()
                         batch_data = []
@@ -135,13 +150,13 @@ def make_bio_table(dbname, folder_path, batch_size=2000):
         cursor.executemany('''
         INSERT OR REPLACE INTO BioTable (PIQPersonID, FullName, Gender,
                                          CityOfBirth, CountryOfBirth,
-                                         DateOfBirth, DOBINT, ExperienceGroup,
+                                         DateOfBirth, DOBINT, BirthYear, ExperienceGroup,
                                          ImageURL, LanguageLabel, IntCode,
                                          InterviewDate, Aliases,
                                          InterviewLength, InVHAOnline,
                                          Interviewers, InterviewLocation,
                                          OrganizationName)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         ''', batch_data)
         conn.commit()
     cursor.execute("PRAGMA optimize;")
@@ -516,6 +531,22 @@ def make_testimony_table(dbname, directory_path, batch_size=2000):
     cursor.close()
     conn.close()
 
+def add_birth_year(dbname):
+    """Add and fill the BirthYear column on an existing BioTable. Used for the year of birth filter."""
+    conn = sqlite3.connect(dbname, timeout=10)
+    cursor = conn.cursor()
+    columns = [row[1] for row in cursor.execute("PRAGMA table_info(BioTable);")]
+    if 'BirthYear' not in columns:
+        cursor.execute("ALTER TABLE BioTable ADD COLUMN BirthYear INTEGER;")
+    cursor.execute("SELECT rowid, DateOfBirth, DOBINT FROM BioTable;")
+    rows = [(birth_year(date_text, dobint), rowid) for rowid, date_text, dobint in cursor.fetchall()]
+    cursor.executemany("UPDATE BioTable SET BirthYear = ? WHERE rowid = ?", rows)
+    conn.commit()
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_birthyear ON BioTable(BirthYear)")
+    cursor.execute("PRAGMA optimize;")
+    cursor.close()
+    conn.close()
+
 # %% Write database file.
 
 
@@ -585,12 +616,17 @@ create_index(db_name, 'QuestionsTable', 'PIQPersonID', 'idx_piq')
 
 create_index(db_name, 'BioTable', 'PIQPersonID', 'idx_piq')
 create_index(db_name, 'BioTable', 'DateOfBirth', 'idx_birthdate')
+create_index(db_name, 'BioTable', 'BirthYear', 'idx_birthyear')
 create_index(db_name, 'BioTable', 'LanguageLabel', 'idx_lang')
 create_index(db_name, 'BioTable', 'ExperienceGroup', 'idx_exp')
 create_index(db_name, 'BioTable', 'CountryOfBirth', 'idx_country')
 create_index(db_name, 'BioTable', 'CityOfBirth', 'idx_city')
 create_index(db_name, 'BioTable', 'FullName', 'idx_name')
 
+# %% Adding BirthYear (and idx_birthyear) to a database made before the column existed.
+
+# add_birth_year(db_name)
+
 # %%
 # KEYWORDSTABLE INDEXES
 
@@ -674,6 +710,29 @@ conn.commit()
 cursor.execute("PRAGMA optimize;")
 conn.close()
 
+# %% Trigram index and sound-alike word tables of the names and aliases for the search bar (src/name_search.py).
+from src.name_search import make_name_index
+make_name_index(db_name)
+
+# %% Distinct labels with their number of people, for the dropdown type-ahead (src/label_index.py).
+from src.label_index import make_label_table
+make_label_table(db_name)
+
+# %% Caption level testimony table with the WebVTT timecodes, and its FTS5 index (src/caption_index.py).
+from src.caption_index import make_caption_table, make_caption_fts
+for directory in ["VHA/VHA/English.batch1/English/batch1/", "VHA/VHA/English.batch2/English/batch2/",
+                  "VHA/VHA/English.batch3/English/batch3/", "VHA/VHA/English.batch4/English/batch4/",
+                  "VHA/VHA/English.batch5/English/batch5/", "VHA/VHA/English.batch6/English/batch6/",
+                  "VHA/VHA/German/German/", "VHA/VHA/Czech/Czech"]:
+    make_caption_table(db_name, directory)
+make_caption_fts(db_name)
+
+# %% Word cloud keywords of every tape and full interview, extracted in parallel. Takes hours.
+# Run after the fts5 table. Can be stopped and started again, it skips what is done.
+# from src.wordcloud_keywords import make_wordcloud_table
+# if __name__ == "__main__":
+#     make_wordcloud_table(db_name)
+
 # %% VACUUMING, probably takes a while. I dunno.
 
 # conn = sqlite3.connect(db_name)
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+Startup helpers: the startup queries, timing of the startup phases, and lazy
+loading of the heavy models and resources that are only needed by some
+callbacks.
+"""
+import os
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+import pandas as pd
+from src.database import SQLiteConnection
+
+startup_times = {}
+
+
+@contextmanager
+def startup_phase(name):
+    """Time a phase of the startup and print how long it took."""
+    start = time.time()
+    yield
+    startup_times[name] = time.time() - start
+    print(f'Startup: {name} took {startup_times[name]:.2f} seconds')
+
+
+def print_startup_summary():
+    """Print the total startup time and the slowest phase."""
+    if startup_times:
+        slowest = max(startup_times, key=startup_times.get)
+        print(f'Startup: {sum(startup_times.values()):.2f} seconds in total, slowest was {slowest}')
+
+
+class Lazy:
+    """Value made by factory() the first time get() is called. Threads asking at the same time wait for it."""
+
+    _instances = weakref.WeakSet()
+
+    def __init__(self, factory):
+        self.factory = factory
+        self._value = None
+        self._loaded = False
+        self._lock = threading.Lock()
+        Lazy._instances.add(self)
+
+    def get(self):
+        """Return the value, making it if needed."""
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    start = time.time()
+                    self._value = self.factory()
+                    self._loaded = True
+                    print(f'Loaded {self.factory.__name__} in {time.time() - start:.2f} seconds')
+        return self._value
+
+    @classmethod
+    def reset_after_fork(cls):
+        """New locks. Run in forked processes, where a lock held by another thread of the parent is never released.
+        A value the parent was still making is made again in the child."""
+        for lazy in list(cls._instances):
+            lazy._lock = threading.Lock()
+
+
+# Background callbacks run in forked processes (see main.py).
+os.register_at_fork(after_in_child=Lazy.reset_after_fork)
+
+
+def ensure_nltk_data(resources):
+    """Make sure the NLTK resources are there, downloading only the missing ones.
+
+    resources maps resource paths to package names, e.g. {'corpora/stopwords': 'stopwords'}.
+    Works offline when the data is installed; if a download fails it prints a warning instead of raising.
+    """
+    import nltk
+    for path, package in resources.items():
+        try:
+            nltk.data.find(path)
+        except LookupError:
+            try:
+                if not nltk.download(package, quiet=True):
+                    print(f'Could not download NLTK resource {package}')
+            except (OSError, ValueError) as e:
+                print(f'Could not download NLTK resource {package}: {e}')
+
+
+def get_answer(db_name, q):
+    """Use for counting answers by question."""
+    with SQLiteConnection(db_name) as (conn, cursor):
+        query = f"""
+            SELECT DISTINCT PIQPersonID, Answer
+            FROM QuestionsTable
+            WHERE QuestionText = '{q}'
+        ;
+        """
+        df = pd.read_sql_query(query, conn)
+    return df
+
+
+def get_coords_byquestion(db_name, question):
+    """Get the coordinates of keywords depending on the question input."""
+    with SQLiteConnection(db_name) as (conn, cursor):
+        query = f"""
+            SELECT DISTINCT Q.PIQPersonID, Answer, Latitude, Longitude
+            FROM QuestionsTable Q
+            LEFT JOIN KeywordsTable K ON Answer = KeywordLabel
+            WHERE
+                Latitude IS NOT NULL
+                AND QuestionText = '{question}'
+        ;
+        """
+        return pd.read_sql_query(query, conn)
+
+
+def answers_with_coordinates(db_name, question, coordinates_df):
+    """Answers to a question, with the coordinates of the place they name."""
+    df = get_answer(db_name, question)
+    df = pd.merge(df, coordinates_df,
+                  left_on='Answer',
+                  right_on='KeywordLabel',
+                  how='left')
+    return df.dropna()
+
+
+# Names of the dataframes made by load_startup_frames.
+startup_frame_names = ['exp_group', 'datatable_alldata', 'birth', 'coordinates', 'countries', 'hiding', 'liberation',
+                       'ghettos', 'allcamps', 'deathcamps', 'concamps', 'interncamps', 'powcamps']
+
+
+def load_startup_frames(db_name):
+    """Run the startup queries. Returns the dataframes the app is built from, by name (startup_frame_names)."""
+    frames = {}
+    with SQLiteConnection(db_name) as (conn, cursor):
+        # Dictionary for Experience Group dropdown.
+        query = """
+            SELECT ExperienceGroup, COUNT(DISTINCT PIQPersonID) as count
+            FROM BioTable
+            GROUP BY ExperienceGroup
+            ORDER BY count DESC
+        ;"""
+        frames['exp_group'] = pd.read_sql_query(query, conn)
+
+        # Table that accompanies tag cloud. Filled with dummy data here.
+        query = """
+        SELECT DISTINCT KeywordLabel, COUNT(*) as count, ParentLabel, RootLabel
+        FROM KeywordsTable
+        GROUP BY KeywordLabel
+        ORDER BY count DESC
+        LIMIT 20
+        ;
+        """
+        frames['datatable_alldata'] = pd.read_sql_query(query, conn)
+
+        # birthplaces dataframe. Used for map.
+        query = """
+        SELECT DISTINCT
+            BioTable.PIQPersonID,
+            Subquery.KeywordLabel,
+            BioTable.CityOfBirth,
+            Subquery.Latitude,
+            Subquery.Longitude
+        FROM BioTable
+        LEFT JOIN (
+            SELECT DISTINCT
+                KeywordLabel,
+                Latitude,
+                Longitude
+            FROM KeywordsTable
+            WHERE Latitude IS NOT NULL
+        ) AS Subquery
+        ON BioTable.CityOfBirth = Subquery.KeywordLabel
+        """
+        frames['birth'] = pd.read_sql_query(query, conn)
+
+        # Getting all locations.
+        query = """
+        SELECT DISTINCT
+            KeywordsTable.KeywordLabel, KeywordsTable.Latitude, KeywordsTable.Longitude
+        FROM KeywordsTable
+        WHERE
+            KeywordsTable.Latitude IS NOT NULL
+        AND
+            KeywordsTable.Longitude IS NOT NULL
+        ;
+        """
+        frames['coordinates'] = pd.read_sql_query(query, conn)
+
+        query = """
+        SELECT DISTINCT CountryOfBirth
+        FROM BioTable
+        ;"""
+        frames['countries'] = pd.read_sql_query(query, conn).dropna()
+
+    frames['hiding'] = get_coords_byquestion(db_name, 'Hiding or Living under False Identity (Location)')
+    frames['liberation'] = answers_with_coordinates(db_name, 'Location of Liberation', frames['coordinates'])
+    frames['ghettos'] = answers_with_coordinates(db_name, "Ghetto(s)", frames['coordinates'])
+    # Same as above but for all camps which will then be segmented further.
+    allcamps_df = answers_with_coordinates(db_name, "Camp(s)", frames['coordinates'])
+    frames['allcamps'] = allcamps_df
+
+    # camp types?
+    frames['deathcamps'] = allcamps_df[allcamps_df["KeywordLabel"].str.contains(
+        "Death Camp", na=False, case=False)]
+    frames['concamps'] = allcamps_df[allcamps_df["KeywordLabel"].str.contains(
+        r"Concentration Camp|Concentation Camp", na=False, case=False)]
+    frames['interncamps'] = allcamps_df[allcamps_df["KeywordLabel"].str.contains(
+        r"Internment Camp|internment Camp", na=False, case=False)]
+    frames['powcamps'] = allcamps_df[allcamps_df["KeywordLabel"].str.contains(
+        r"POW Camp|POW", na=False, case=False)]
+    return frames
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+Ranked search in the testimonies.
+
+The testimony filter only uses TestimonyTable_fts to find which people said
+the search terms. This ranks those interviews with FTS5's bm25(), and gives
+an excerpt around the terms from snippet() and where they are, one page at a
+time, so the user can open the right place instead of reading whole
+interviews: the captions with the terms and their timecodes if the database
+has CaptionTable_fts (src/caption_index.py), else the tapes with the terms.
+"""
+import json
+import sqlite3
+from src.caption_index import caption_hits
+from src.cohort import testimony_match
+
+page_size = 10
+snippet_tokens = 40  # Length of the excerpts, in words.
+
+
+def _like_pattern(term):
+    """A term as a LIKE ... ESCAPE '\\' pattern for a tape containing it."""
+    return '%' + term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+
+def search_testimonies(cursor, terms, piqs=None, page=1):
+    """One page of the interviews with all the terms, best bm25 first, limited to the PIQs piqs if given.
+
+    Returns the number of interviews and the page as dicts with IntCode, PIQPersonID, FullName,
+    Score (higher is better), Snippet (markdown, terms in bold), HitCount and Hits, the first captions
+    with any of the terms (see caption_hits). Without the caption index the hits are the tapes with
+    any of the terms, with CaptionNumber 0 and no StartTime or Caption.
+    """
+    params = {'match': testimony_match(terms), 'limit': page_size, 'offset': page_size * (page - 1)}
+    cohort = ''
+    if piqs is not None:
+        cohort = "AND F.PIQPersonID IN (SELECT value FROM json_each(:piqs))"
+        params['piqs'] = json.dumps(list(piqs))
+    cursor.execute(f"""
+        SELECT COUNT(*)
+        FROM TestimonyTable_fts F
+        WHERE TestimonyTable_fts MATCH :match {cohort}
+        ;""", params)
+    count = cursor.fetchone()[0]
+    cursor.execute(f"""
+        SELECT
+            F.IntCode,
+            F.PIQPersonID,
+            B.FullName,
+            -bm25(TestimonyTable_fts) AS Score,
+            snippet(TestimonyTable_fts, 0, '**', '**', ' ... ', {snippet_tokens}) AS Snippet
+        FROM TestimonyTable_fts F
+        LEFT JOIN BioTable B ON B.PIQPersonID = F.PIQPersonID
+        WHERE TestimonyTable_fts MATCH :match {cohort}
+        ORDER BY bm25(TestimonyTable_fts)
+        LIMIT :limit OFFSET :offset
+        ;""", params)
+    columns = [d[0] for d in cursor.description]
+    results = [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    try:
+        for result in results:
+            result['HitCount'], result['Hits'] = caption_hits(cursor, result['IntCode'], terms)
+    except sqlite3.OperationalError:  # Database made before CaptionTable_fts.
+        for result in results:
+            result['Hits'] = _tape_hits(cursor, result['IntCode'], terms)
+            result['HitCount'] = len(result['Hits'])
+    return count, results
+
+
+def _tape_hits(cursor, intcode, terms):
+    """The tapes of an interview with any of the terms, as hits without a caption."""
+    # TestimonyTable_fts has whole interviews, so the tapes are found by searching only the tapes of this interview.
+    tape_condition = ' OR '.join("TapeTestimony LIKE ? ESCAPE '\\'" for _ in terms)
+    cursor.execute(f"""
+        SELECT TapeNumber
+        FROM TestimonyTable
+        WHERE IntCode = ? AND ({tape_condition})
+        ORDER BY TapeNumber
+        ;""", [intcode, *map(_like_pattern, terms)])
+    return [{'TapeNumber': r[0], 'CaptionNumber': 0, 'StartTime': None, 'Caption': None} for r in cursor.fetchall()]
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+TF-IDF keywords for the testimony word clouds, a cheap alternative to KeyBERT.
+
+The document frequency of every word over the tapes of TestimonyTable is
+computed once and stored in TermTable. A word cloud is then one sparse count
+vector of the testimony times the idf weights, which takes milliseconds.
+
+Run from the project root, with write access to the database:
+
+    python -m src.tfidf_keywords build [databases/nov18.db]
+    python -m src.tfidf_keywords compare [databases/nov18.db] [--samples 50]
+
+compare prints how much the TF-IDF word clouds overlap with the KeyBERT ones,
+and how long each takes. The app uses TF-IDF when HNP_WORDCLOUD_ENGINE=tfidf.
+"""
+import argparse
+import random
+import sqlite3
+import time
+from collections import Counter
+import numpy as np
+from sklearn.feature_extraction.text import CountVectorizer
+from src.wordcloud_keywords import top_n, keywords_for_texts, lookup_wordcloud
+
+# Words in fewer tapes than this are left out of TermTable (mostly typos and transcription noise).
+min_doc_freq = 2
+
+
+def _vectorizer(vocabulary=None):
+    """Same tokens as KeyBERT's default CountVectorizer with stop_words='english'."""
+    return CountVectorizer(stop_words='english', vocabulary=vocabulary)
+
+
+class TfidfEngine:
+    """Keyword scores from term counts and the idf weights of TermTable."""
+
+    def __init__(self, terms, doc_freq, n_docs):
+        self.vectorizer = _vectorizer({term: i for i, term in enumerate(terms)})
+        self.terms = np.asarray(terms, dtype=object)
+        self.idf = np.log((1 + n_docs) / (1 + np.asarray(doc_freq, dtype=np.float64))) + 1
+
+    @classmethod
+    def from_connection(cls, conn):
+        """Load the idf weights. Returns None if the database has no TermTable."""
+        try:
+            rows = conn.execute("SELECT Term, DocFreq FROM TermTable;").fetchall()
+            n_docs = conn.execute("SELECT COUNT(*) FROM TestimonyTable;").fetchone()[0]
+        except sqlite3.OperationalError:
+            return None
+        if not rows:
+            return None
+        terms, doc_freq = zip(*rows)
+        return cls(terms, doc_freq, n_docs)
+
+    def keywords(self, text, n=top_n):
+        """The n best [word, score] of a text, best first, like keywords_for_texts."""
+        counts = self.vectorizer.transform([text or ''])
+        scores = (1 + np.log(counts.data)) * self.idf[counts.indices]  # Sublinear term frequency.
+        best = np.argsort(-scores, kind='stable')[:n]
+        return [[self.terms[counts.indices[i]], float(scores[i])] for i in best]
+
+
+def make_term_table(dbname, batch_size=2000):
+    """Count in how many tapes of TestimonyTable each word appears, and store it in TermTable."""
+    analyzer = _vectorizer().build_analyzer()
+    doc_freq = Counter()
+    conn = sqlite3.connect(dbname, timeout=10)
+    cursor = conn.cursor()
+    cursor.execute("SELECT TapeTestimony FROM TestimonyTable;")
+    count = 0
+    start = time.time()
+    while True:
+        batch = cursor.fetchmany(batch_size)
+        if not batch:
+            break
+        for (text,) in batch:
+            doc_freq.update(set(analyzer(text or '')))
+        count += len(batch)
+        print(f"{count} tapes counted so far")
+
+    cursor.execute("DROP TABLE IF EXISTS TermTable;")
+    cursor.execute('''
+    CREATE TABLE TermTable (
+        Term TEXT PRIMARY KEY,
+        DocFreq INTEGER
+    ) WITHOUT ROWID
+    ''')
+    cursor.executemany('''
+    INSERT INTO TermTable (Term, DocFreq)
+    VALUES (?, ?)
+    ''', [(term, n) for term, n in doc_freq.items() if n >= min_doc_freq])
+    conn.commit()
+    print(f"{len(doc_freq)} words in {count} tapes counted in {time.time() - start:.0f} seconds")
+    cursor.execute("PRAGMA optimize;")
+    cursor.close()
+    conn.close()
+
+
+def compare(dbname, samples=50, top=(20, 100)):
+    """Print the overlap of the TF-IDF and KeyBERT word clouds of random tapes, and their speed."""
+    conn = sqlite3.connect(f'file:{dbname}?mode=ro', uri=True)
+    cursor = conn.cursor()
+    engine = TfidfEngine.from_connection(conn)
+    if engine is None:
+        raise SystemExit('No TermTable, run the build first')
+    keys = cursor.execute("SELECT IntCode, TapeNumber FROM TestimonyTable;").fetchall()
+    keys = random.sample(keys, min(samples, len(keys)))
+    model = None
+    overlaps = {n: [] for n in top}
+    times = {'tfidf': 0.0, 'keybert': 0.0}
+    keybert_runs = 0
+    for intcode, tape_number in keys:
+        text = cursor.execute("""
+            SELECT TapeTestimony
+            FROM TestimonyTable
+            WHERE IntCode = ? AND TapeNumber = ?;""", (intcode, tape_number)).fetchone()[0]
+        start = time.time()
+        tfidf = [word for word, _ in engine.keywords(text)]
+        times['tfidf'] += time.time() - start
+
+        keybert = lookup_wordcloud(cursor, intcode, tape_number)
+        if keybert is None:
+            if model is None:
+                from keybert import KeyBERT
+                model = KeyBERT()
+            start = time.time()
+            keybert = keywords_for_texts(model, [text])[0]
+            times['keybert'] += time.time() - start
+            keybert_runs += 1
+        keybert = [word for word, _ in keybert]
+
+        for n in top:
+            if keybert[:n]:
+                overlaps[n].append(len(set(tfidf[:n]) & set(keybert[:n])) / len(keybert[:n]))
+    conn.close()
+
+    for n in top:
+        print(f"Top {n}: on average {100 * np.mean(overlaps[n]):.0f}% of the KeyBERT words are also in TF-IDF")
+    print(f"TF-IDF: {1000 * times['tfidf'] / len(keys):.1f} ms per tape")
+    if keybert_runs:
+        print(f"KeyBERT: {1000 * times['keybert'] / keybert_runs:.1f} ms per tape ({keybert_runs} not in WordcloudTable)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['build', 'compare'])
+    parser.add_argument('db_name', nargs='?', default='databases/nov18.db')
+    parser.add_argument('--samples', type=int, default=50)
+    args = parser.parse_args()
+    if args.command == 'build':
+        make_term_table(args.db_name)
+    else:
+        compare(args.db_name, args.samples)
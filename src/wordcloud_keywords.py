@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+Precomputed KeyBERT keywords for the testimony word clouds.
+
+Extracting the keywords of a testimony takes seconds, so it is done once for
+every tape (TestimonyTable) and every full interview (TestimonyTable_fts) and
+stored in WordcloudTable, with TapeNumber 0 for the full interview. The app then
+only looks them up, and extracts them itself only for testimonies missing
+from the table.
+
+Run from the project root, with write access to the database:
+
+    python -m src.wordcloud_keywords [databases/nov18.db] [--processes 4]
+
+Testimonies already in the table are skipped, so it can be stopped and
+started again.
+"""
+import argparse
+import json
+import multiprocessing
+import sqlite3
+import time
+
+top_n = 100
+full_interview = 0  # TapeNumber of the keywords of a whole interview.
+
+_model = None  # CachedKeyBERT model of a worker process.
+
+
+def keywords_for_texts(model, texts, keys=None):
+    """Word cloud keywords ([word, score] lists) of each text.
+
+    keys, the (IntCode, TapeNumber) of each text, lets a CachedKeyBERT model reuse document embeddings.
+    """
+    if keys is None:
+        results = model.extract_keywords(docs=texts, top_n=top_n, stop_words='english')
+    else:
+        results = model.extract_keywords(docs=texts, top_n=top_n, stop_words='english',
+                                         doc_keys=[f'{intcode}:{tape}' for intcode, tape in keys])
+    if len(texts) == 1:  # KeyBERT drops the outer list for a single document.
+        results = [results]
+    return [[list(tup) for tup in keywords] for keywords in results]
+
+
+def lookup_wordcloud(cursor, intcode, tape_number):
+    """Stored keywords of a tape (or full_interview), or None if they are not in WordcloudTable."""
+    try:
+        cursor.execute("""
+            SELECT Keywords
+            FROM WordcloudTable
+            WHERE IntCode = ? AND TapeNumber = ?
+            ;""", (intcode, tape_number))
+    except sqlite3.OperationalError:  # Database made before WordcloudTable.
+        return None
+    row = cursor.fetchone()
+    return json.loads(row[0]) if row else None
+
+
+def wordcloud_table_complete(cursor):
+    """True if WordcloudTable has the keywords of every tape and every full interview.
+
+    Stops at the first testimony missing from the table, so it is cheap when the table is incomplete.
+    """
+    try:
+        cursor.execute(f"""
+            SELECT 1
+            FROM TestimonyTable T
+            WHERE NOT EXISTS (
+                SELECT 1 FROM WordcloudTable W
+                WHERE W.IntCode = T.IntCode AND W.TapeNumber = T.TapeNumber)
+            OR NOT EXISTS (
+                SELECT 1 FROM WordcloudTable W
+                WHERE W.IntCode = T.IntCode AND W.TapeNumber = {full_interview})
+            LIMIT 1
+            ;""")
+    except sqlite3.OperationalError:  # Database made before WordcloudTable.
+        return False
+    return cursor.fetchone() is None
+
+
+def _init_worker():
+    """Load the model once per worker, with one torch thread so the processes don't compete for cores.
+
+    The embedding cache is kept in memory, so each worker encodes a word only once over all its testimonies.
+    """
+    global _model
+    try:
+        import torch
+        torch.set_num_threads(1)
+    except ImportError:
+        pass
+    from keybert import KeyBERT
+    from src.embedding_cache import EmbeddingCache, CachedKeyBERT
+    _model = CachedKeyBERT(KeyBERT(), EmbeddingCache())
+
+
+def _extract(batch):
+    """Keywords of a batch of (IntCode, TapeNumber, text). Runs in a worker."""
+    keywords = keywords_for_texts(_model, [text or '' for _, _, text in batch],
+                                  [(intcode, tape) for intcode, tape, _ in batch])
+    return [(intcode, tape, json.dumps(kw)) for (intcode, tape, _), kw in zip(batch, keywords)]
+
+
+def _missing_testimonies(dbname, batch_size):
+    """Batches of (IntCode, TapeNumber, text) of the testimonies not in WordcloudTable yet."""
+    conn = sqlite3.connect(f'file:{dbname}?mode=ro', uri=True)
+    cursor = conn.cursor()
+    cursor.execute(f"""
+        SELECT IntCode, TapeNumber, TapeTestimony
+        FROM TestimonyTable T
+        WHERE NOT EXISTS (
+            SELECT 1 FROM WordcloudTable W
+            WHERE W.IntCode = T.IntCode AND W.TapeNumber = T.TapeNumber)
+        UNION ALL
+        SELECT IntCode, {full_interview}, TapeTestimony
+        FROM TestimonyTable_fts F
+        WHERE NOT EXISTS (
+            SELECT 1 FROM WordcloudTable W
+            WHERE W.IntCode = F.IntCode AND W.TapeNumber = {full_interview})
+        ;""")
+    while True:
+        batch = cursor.fetchmany(batch_size)
+        if not batch:
+            break
+        yield batch
+    conn.close()
+
+
+def make_wordcloud_table(dbname, processes=None, batch_size=8):
+    """Create WordcloudTable and fill it with the keywords of the testimonies that are missing."""
+    conn = sqlite3.connect(dbname, timeout=10)
+    cursor = conn.cursor()
+    # WAL, so the testimonies can be read on one connection while the results are written on this one.
+    # Only while this runs: the app opens the database read-only, where -wal and -shm files must not be left.
+    journal_mode = cursor.execute("PRAGMA journal_mode;").fetchone()[0]
+    cursor.execute("PRAGMA journal_mode = WAL;")
+    try:
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS WordcloudTable (
+            IntCode INTEGER,
+            TapeNumber INTEGER,
+            Keywords TEXT,
+            PRIMARY KEY (IntCode, TapeNumber)
+        ) WITHOUT ROWID
+        ''')
+        conn.commit()
+
+        count = 0
+        start = time.time()
+        with multiprocessing.Pool(processes, initializer=_init_worker) as pool:
+            for rows in pool.imap_unordered(_extract, _missing_testimonies(dbname, batch_size)):
+                cursor.executemany('''
+                INSERT OR REPLACE INTO WordcloudTable (IntCode, TapeNumber, Keywords)
+                VALUES (?, ?, ?)
+                ''', rows)
+                conn.commit()
+                count += len(rows)
+                if count % 500 < len(rows):
+                    print(f"{count} testimonies processed so far, {count / (time.time() - start):.1f} per second")
+        print(f"{count} testimonies processed in {time.time() - start:.0f} seconds")
+        cursor.execute("PRAGMA optimize;")
+    finally:
+        try:
+            restored = cursor.execute(f"PRAGMA journal_mode = {journal_mode};").fetchone()[0]
+        except sqlite3.OperationalError:
+            restored = 'wal'
+        if restored.lower() != journal_mode.lower():
+            print(f"Could not set the journal mode back to {journal_mode}, "
+                  f"run PRAGMA journal_mode = {journal_mode} on {dbname}")
+        cursor.close()
+        conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('db_name', nargs='?', default='databases/nov18.db')
+    parser.add_argument('--processes', type=int, default=None, help='worker processes, default one per core')
+    parser.add_argument('--batch-size', type=int, default=8, help='testimonies per model call')
+    args = parser.parse_args()
+    make_wordcloud_table(args.db_name, args.processes, args.batch_size)